@@ -0,0 +1,283 @@
+"""
+Headless benchmark for the MafiaGame state machine. Plays complete games with
+in-memory connections, so only game logic is measured (no sockets, no JSON
+parsing of inbound frames).
+
+    python bench.py --games 2000 --save before.json
+    python bench.py --games 2000 --compare before.json
+
+Times every update() call by (state, event) plus the hot helpers, and measures
+traced memory per game in a separate pass (tracemalloc slows everything down).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List
+
+from codec import codec
+from player import Head
+from registry import BROWSER, RPI
+from game import MafiaGame, MAX_PLAYERS
+
+PLAYER_COUNTS = [3, 7, MAX_PLAYERS, MAX_PLAYERS + 4]
+HOT_METHODS = ["handle_vote", "mafia_kill", "doctor_save", "check_game_over"]
+MAX_ROUNDS = 100  # a game that hasn't ended by then is stuck
+
+
+class FakeWebSocket:
+    def __init__(self, name: str):
+        self.remote_address = (name, 0)
+
+
+class SinkOutbox:
+    """Stands in for Outbox: counts frames instead of sending them"""
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def put(self, frame, droppable: bool = False) -> bool:
+        self.frames += 1
+        self.bytes += len(frame)
+        return True
+
+    def close(self):
+        pass
+
+
+class Timings:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)  # label -> seconds
+
+    def wrap(self, label: str, func):
+        samples = self.samples[label]
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            result = func(*args, **kwargs)
+            samples.append(time.perf_counter() - started)
+            return result
+        return timed
+
+    def summary(self) -> Dict[str, dict]:
+        return {label: summarize(values) for label, values in sorted(self.samples.items()) if values}
+
+
+def summarize(values: List[float]) -> dict:
+    ordered = sorted(values)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1e6
+
+    return {
+        "count": len(ordered),
+        "mean_us": sum(ordered) / len(ordered) * 1e6,
+        "p50_us": pct(50),
+        "p95_us": pct(95),
+        "p99_us": pct(99),
+    }
+
+
+def new_table(num_players: int, timings: Timings | None = None) -> MafiaGame:
+    """A room with num_players seated, each with a browser and an rpi connection"""
+    game = MafiaGame(f"bench-{num_players}")
+    game.max_players = max(num_players, MAX_PLAYERS)
+    for player_id in range(1, num_players + 1):
+        name = f"p{player_id}"
+        browser, rpi = FakeWebSocket(name), FakeWebSocket(name + "-rpi")
+        game.add_player(name, player_id)
+        game.connections.open(browser, SinkOutbox())
+        game.connections.open(rpi, SinkOutbox())
+        game.attach(browser, name, BROWSER)
+        game.attach(rpi, name, RPI)
+    if timings is not None:
+        for method in HOT_METHODS:
+            setattr(game, method, timings.wrap(method, getattr(game, method)))
+    return game
+
+
+async def update(game: MafiaGame, event: str, timings: Timings | None):
+    if timings is None:
+        await game.update(event)
+        return
+    label = f"{game.state}:{event}"
+    started = time.perf_counter()
+    await game.update(event)
+    timings.samples[label].append(time.perf_counter() - started)
+
+
+async def play_game(game: MafiaGame, rng: random.Random, timings: Timings | None = None):
+    """Drive one game from LOBBY to GAMEOVER and back, the way the handler would"""
+    for name in game.players:
+        game.set_ready(name)
+        await update(game, "ready", timings)
+    game.pending_code = 2
+    await update(game, "voiceCommand", timings)
+
+    for _ in range(MAX_ROUNDS):
+        if game.state == "GAMEOVER":
+            break
+        alive = [name for name, player in game.players.items() if player.alive]
+        if game.state == "HEADSDOWN":
+            for name in alive:
+                if game.valid_signal("headDown"):
+                    game.set_head(name, Head.DOWN)
+                    await update(game, "headDown", timings)
+        elif game.state == "MAFIAVOTE":
+            target = rng.choice(alive)
+            for name in (game.mafia_name_one, game.mafia_name_two):
+                if game.is_alive(name) and game.state == "MAFIAVOTE":
+                    game.players[name].kill = target
+                    await update(game, "targeted", timings)
+        elif game.state == "DOCTORVOTE":
+            target = rng.choice(alive)
+            for name in (game.doctor_name_one, game.doctor_name_two):
+                if game.is_alive(name) and game.state == "DOCTORVOTE":
+                    game.players[name].save = target
+                    await update(game, "targeted", timings)
+        elif game.state == "PREVOTE":
+            game.pending_code = 3
+            await update(game, "voiceCommand", timings)
+        elif game.state == "VOTE":
+            for name in alive:
+                if game.state == "VOTE":
+                    game.set_vote(name, rng.choice(alive))
+                    await update(game, "targeted", timings)
+        else:
+            raise RuntimeError(f"Benchmark stuck in {game.state}")
+    else:
+        raise RuntimeError(f"Game did not finish within {MAX_ROUNDS} rounds")
+
+    winner = game.game_winner
+    for name in game.players:
+        game.set_restart(name)
+        await update(game, "restart", timings)
+    return winner
+
+
+async def bench_player_count(num_players: int, games: int, seed: int, memory_games: int) -> dict:
+    rng = random.Random(seed)
+    timings = Timings()
+    game = new_table(num_players, timings)
+    game.rng.seed(seed)  # role draws
+    winners: Dict[str, int] = defaultdict(int)
+    game_times = []
+    for _ in range(games):
+        started = time.perf_counter()
+        winners[await play_game(game, rng, timings)] += 1
+        game_times.append(time.perf_counter() - started)
+    outboxes = [conn.outbox for conn in game.connections]
+
+    # Memory pass on a fresh table, untimed
+    game = new_table(num_players)
+    await play_game(game, rng)  # warm caches so they don't count as per-game cost
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for _ in range(memory_games):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            await play_game(game, rng)
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(current - before)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "games": games,
+        "winners": dict(winners),
+        "game": summarize(game_times),
+        "frames_per_game": sum(o.frames for o in outboxes) / games,
+        "bytes_per_game": sum(o.bytes for o in outboxes) / games,
+        "peak_alloc_bytes_per_game": sum(peaks) / len(peaks) if peaks else 0,
+        "retained_bytes_per_game": sum(retained) / len(retained) if retained else 0,
+        "timings": timings.summary(),
+    }
+
+
+def print_report(results: dict):
+    for count, result in results["players"].items():
+        game = result["game"]
+        print(f"\n== {count} players: {result['games']} games, {game['mean_us'] / 1000:.2f} ms/game, "
+              f"{result['frames_per_game']:.0f} frames/game, "
+              f"{result['peak_alloc_bytes_per_game'] / 1024:.1f} KiB peak alloc/game, "
+              f"{result['retained_bytes_per_game']:.0f} B retained/game")
+        print(f"{'transition':<28}{'count':>9}{'mean us':>10}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}")
+        for label, stats in result["timings"].items():
+            print(f"{label:<28}{stats['count']:>9}{stats['mean_us']:>10.2f}{stats['p50_us']:>10.2f}"
+                  f"{stats['p95_us']:>10.2f}{stats['p99_us']:>10.2f}")
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    """Print mean-time ratios against a saved run; returns how many regressed past the threshold"""
+    regressions = 0
+    print(f"\n== Compared with baseline from {baseline['meta']['date']} (regression threshold {threshold:+.0%})")
+    for count, result in results["players"].items():
+        old = baseline["players"].get(count)
+        if old is None:
+            continue
+        rows = [("game", result["game"], old["game"])]
+        rows += [(label, stats, old["timings"][label])
+                 for label, stats in result["timings"].items() if label in old["timings"]]
+        for label, new_stats, old_stats in rows:
+            ratio = new_stats["mean_us"] / old_stats["mean_us"] - 1 if old_stats["mean_us"] else 0.0
+            flag = ""
+            if ratio > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"{count:>3}p {label:<28}{old_stats['mean_us']:>10.2f} -> {new_stats['mean_us']:>10.2f} us "
+                  f"({ratio:+.1%}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MafiaGame transitions headlessly")
+    parser.add_argument("--games", type=int, default=1000, help="games per player count")
+    parser.add_argument("--players", default=",".join(map(str, PLAYER_COUNTS)),
+                        help="comma-separated player counts")
+    parser.add_argument("--memory-games", type=int, default=50, help="games in the tracemalloc pass")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="relative slowdown that counts as a regression in --compare")
+    args = parser.parse_args()
+
+    # Game logging is not what's being measured
+    logging.getLogger("mafia").setLevel(logging.WARNING)
+
+    results = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "codec": codec.name,
+            "seed": args.seed,
+        },
+        "players": {},
+    }
+    for count in (int(c) for c in args.players.split(",")):
+        results["players"][str(count)] = asyncio.run(
+            bench_player_count(count, args.games, args.seed, args.memory_games))
+
+    print_report(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Union
+
+from log import get_logger
+
+log = get_logger("codec")
+
+# "auto" picks the fastest installed backend; "orjson", "msgspec" or "json" force one
+CODEC = os.environ.get("MAFIA_CODEC", "auto").lower()
+
+
+class Codec:
+    """Turns protocol objects into websocket text frames and back (stdlib json)"""
+    name = "json"
+    # What loads() raises on a malformed frame (TypeError: not str/bytes at all)
+    errors = (json.JSONDecodeError, UnicodeDecodeError, TypeError)
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+    def loads(self, data: Union[str, bytes]):
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self.errors = (orjson.JSONDecodeError, TypeError)
+
+    def dumps(self, obj) -> str:
+        # Text frames: browsers can't JSON.parse a binary frame
+        return self._orjson.dumps(obj).decode()
+
+    def loads(self, data: Union[str, bytes]):
+        return self._orjson.loads(data)
+
+
+class MsgspecCodec(Codec):
+    name = "msgspec"
+
+    def __init__(self):
+        import msgspec
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+        # msgspec errors derive from Exception, not ValueError
+        self.errors = (msgspec.DecodeError, TypeError)
+
+    def dumps(self, obj) -> str:
+        return self._encoder.encode(obj).decode()
+
+    def loads(self, data: Union[str, bytes]):
+        return self._decoder.decode(data)
+
+
+BACKENDS = {"orjson": OrjsonCodec, "msgspec": MsgspecCodec, "json": Codec}
+
+
+def select_codec(preferred: str = CODEC) -> Codec:
+    """
+    @param preferred: backend name or "auto"
+
+    Falls back to the stdlib json codec when the preferred backend isn't installed
+    """
+    names = ["orjson", "msgspec", "json"] if preferred == "auto" else [preferred, "json"]
+    for name in names:
+        try:
+            return BACKENDS[name]()
+        except (ImportError, KeyError):
+            continue
+    return Codec()
+
+
+codec = select_codec()
+log.debug("Using %s codec", codec.name)
+
+
+@dataclass(slots=True, frozen=True)
+class Message:
+    """One inbound protocol message, validated once when it's decoded"""
+    action: str
+    target: Union[str, int, None] = None
+    name: str | None = None
+    room: str | None = None
+    protocol: str | None = None  # wire protocol requested at setup
+    resume: str | None = None  # resume token from an earlier id_registered
+    deltas: bool = False  # setup: send lobby/restart changes as deltas after one full status
+
+    @property
+    def target_id(self) -> int | None:
+        """The target as a player ID, if it is one (int or numeric string)"""
+        if isinstance(self.target, int) and not isinstance(self.target, bool):
+            return self.target
+        if isinstance(self.target, str) and self.target.isnumeric():
+            return int(self.target)
+        return None
+
+
+def decode_message(data: Union[str, bytes]) -> Message | None:
+    """
+    @param data: raw websocket frame
+
+    Returns a Message, or None if the frame isn't a well-formed protocol message
+    """
+    try:
+        raw = codec.loads(data)
+    except codec.errors:
+        log.warning("Invalid JSON: %r", data)
+        return None
+    if not isinstance(raw, dict) or not isinstance(raw.get("action"), str):
+        log.warning("Message without an action: %r", data)
+        return None
+
+    target = raw.get("target")
+    if isinstance(target, float) and target.is_integer():
+        target = int(target)
+    if target is not None and not isinstance(target, (str, int)):
+        log.warning("Unsupported target in %r", data)
+        return None
+    name = raw.get("name")
+    if name is not None and not isinstance(name, str):
+        name = str(name)
+    room = raw.get("room")
+    if room is not None:
+        room = str(room).strip() or None
+
+    protocol = raw.get("protocol")
+    if not isinstance(protocol, str):
+        protocol = None
+
+    resume = raw.get("resume")
+    if not isinstance(resume, str):
+        resume = None
+
+    message = Message(raw["action"], target, name, room, protocol, resume, raw.get("deltas") is True)
+    log.debug("Parsed %s", message)
+    return message
@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import os
+from dataclasses import asdict, dataclass
+from typing import List
+
+from log import get_logger
+
+log = get_logger("config")
+
+# Every setting can come from the environment; a command line flag wins over it
+HOST = os.environ.get("MAFIA_HOST", "0.0.0.0")
+PORT = int(os.environ.get("MAFIA_PORT", "5050"))
+# "auto" uses uvloop when it's installed, "uvloop" or "asyncio" force one
+LOOP = os.environ.get("MAFIA_LOOP", "auto").lower()
+# Protocol messages are a few hundred bytes at most; anything near this limit is junk
+WS_MAX_SIZE = int(os.environ.get("MAFIA_WS_MAX_SIZE", str(64 * 1024)))
+# Frames buffered per connection before the server stops reading from it
+WS_MAX_QUEUE = int(os.environ.get("MAFIA_WS_MAX_QUEUE", "16"))
+# "none" or "deflate"; deflate costs CPU per frame and saves almost nothing on messages this small
+WS_COMPRESSION = os.environ.get("MAFIA_WS_COMPRESSION", "none").lower()
+# Seconds between keepalive pings, and to wait for the pong (0 turns pings off)
+WS_PING_INTERVAL = float(os.environ.get("MAFIA_WS_PING_INTERVAL", "30"))
+WS_PING_TIMEOUT = float(os.environ.get("MAFIA_WS_PING_TIMEOUT", "30"))
+
+
+@dataclass(slots=True)
+class ServerConfig:
+    host: str = HOST
+    port: int = PORT
+    loop: str = LOOP
+    max_size: int = WS_MAX_SIZE
+    max_queue: int = WS_MAX_QUEUE
+    compression: str = WS_COMPRESSION
+    ping_interval: float = WS_PING_INTERVAL
+    ping_timeout: float = WS_PING_TIMEOUT
+
+    def serve_kwargs(self) -> dict:
+        """Keyword arguments for websockets.serve()"""
+        return {
+            "max_size": self.max_size or None,
+            "max_queue": self.max_queue or None,
+            "compression": "deflate" if self.compression == "deflate" else None,
+            "ping_interval": self.ping_interval or None,
+            "ping_timeout": self.ping_timeout or None,
+        }
+
+
+def parse_args(argv: List[str] | None = None) -> ServerConfig:
+    defaults = ServerConfig()
+    parser = argparse.ArgumentParser(description="Smart Mafia game server")
+    parser.add_argument("--host", default=defaults.host, help="interface to listen on (MAFIA_HOST)")
+    parser.add_argument("--port", type=int, default=defaults.port, help="websocket port (MAFIA_PORT)")
+    parser.add_argument("--loop", choices=("auto", "uvloop", "asyncio"), default=defaults.loop,
+                        help="event loop implementation (MAFIA_LOOP)")
+    parser.add_argument("--max-size", type=int, default=defaults.max_size,
+                        help="largest inbound frame in bytes, 0 for no limit (MAFIA_WS_MAX_SIZE)")
+    parser.add_argument("--max-queue", type=int, default=defaults.max_queue,
+                        help="inbound frames buffered per connection, 0 for no limit (MAFIA_WS_MAX_QUEUE)")
+    parser.add_argument("--compression", choices=("none", "deflate"), default=defaults.compression,
+                        help="permessage-deflate (MAFIA_WS_COMPRESSION)")
+    parser.add_argument("--ping-interval", type=float, default=defaults.ping_interval,
+                        help="seconds between keepalive pings, 0 for none (MAFIA_WS_PING_INTERVAL)")
+    parser.add_argument("--ping-timeout", type=float, default=defaults.ping_timeout,
+                        help="seconds to wait for a pong (MAFIA_WS_PING_TIMEOUT)")
+    args = parser.parse_args(argv)
+    return ServerConfig(**{name: getattr(args, name) for name in asdict(defaults)})
+
+
+def install_loop(preferred: str) -> str:
+    """
+    @param preferred: "auto", "uvloop" or "asyncio"
+
+    Makes the next asyncio.run() use uvloop if asked for and installed. Returns
+    the name of the loop that will actually run.
+    """
+    if preferred == "asyncio":
+        return "asyncio"
+    try:
+        import uvloop
+    except ImportError:
+        if preferred == "uvloop":
+            log.warning("uvloop is not installed, using the asyncio event loop")
+        return "asyncio"
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return "uvloop"
+
+
+def log_summary(config: ServerConfig, loop: str, **extra):
+    """One line per setting at startup, so logs show exactly what a deployment ran with"""
+    settings = {**asdict(config), **extra}
+    settings["loop"] = loop if config.loop in (loop, "auto") else f"{loop} ({config.loop} requested)"
+    log.info("Server settings:")
+    for name, value in settings.items():
+        log.info("  %-14s %s", name, value)
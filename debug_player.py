@@ -1,41 +1,68 @@
 import asyncio
 import json
 import websockets
+from protocol import BINARY, encode_binary, decode_binary
 
 SERVER_IP = "127.0.0.1"
 SERVER_PORT = 5050
 
-async def debug_player(player_name):
+async def debug_player(player_name, room="default", use_binary=False):
     uri = f"ws://{SERVER_IP}:{SERVER_PORT}"
-    
+
     async with websockets.connect(uri, ping_interval = 30, ping_timeout = 30) as ws:
         # Send setup
-        await ws.send(json.dumps({
+        setup = {
             "action": "setup",
             "name": player_name,
-            "target": "rpi"
-        }))
-        print(f"[{player_name}] Connected and sent setup")
-        
+            "target": "rpi",
+            "room": room
+        }
+        if use_binary:
+            setup["protocol"] = BINARY
+        await ws.send(json.dumps(setup))
+        print(f"[{player_name}] Connected to room {room} and sent setup")
+
+        player_id = 0
+        binary = False  # only once the server confirms it
+
         async for message in ws:
-            msg = json.loads(message)
-            print(f"[{player_name}] Received: {msg}")
-            
-            action = msg.get("action")
+            if isinstance(message, bytes):
+                decoded = decode_binary(message)
+                if decoded is None:
+                    print(f"[{player_name}] Invalid binary frame: {message!r}")
+                    continue
+                action = decoded.action
+                print(f"[{player_name}] Received (binary, {len(message)} bytes): {action}")
+            else:
+                msg = json.loads(message)
+                print(f"[{player_name}] Received: {msg}")
+                action = msg.get("action")
+                if action == "id_registered":
+                    player_id = msg.get("player")
+                    binary = (msg.get("target") or {}).get("protocol") == BINARY
+                    print(f"[{player_name}] Registered as player {player_id} ({'binary' if binary else 'json'})")
+                    continue
+
             if action in ["civilian", "mafia", "doctor"]:
                 print(f"[{player_name}] Role: {action}")
                 continue
-            
+
             # When it's voting time
             vote = input(f"[{player_name}] Enter vote (1-4): ").strip()
             print(f'[DEBUG] Registered vote: {vote}')
-            await ws.send(json.dumps({
-                "action": "targeted",
-                "name": player_name,
-                "target": vote
-            }))
+            frame = encode_binary("targeted", player_id, int(vote)) if binary and vote.isnumeric() else None
+            if frame is None:
+                frame = json.dumps({
+                    "action": "targeted",
+                    "name": player_name,
+                    "target": vote
+                })
+            await ws.send(frame)
 
 if __name__ == "__main__":
     import sys
-    name = sys.argv[1] if len(sys.argv) > 1 else "DebugPlayer"
-    asyncio.run(debug_player(name))
+    use_binary = "--binary" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != "--binary"]
+    name = args[0] if len(args) > 0 else "DebugPlayer"
+    room = args[1] if len(args) > 1 else "default"
+    asyncio.run(debug_player(name, room, use_binary))
@@ -2,6 +2,7 @@ import { useEffect, useRef, useState } from 'react';
 import { API_CONFIG } from '../config/api.config';
 
 interface LobbyStatus {
+    seq?: number;
     ready_count: number;
     total_count: number;
     min_players: number;
@@ -10,11 +11,37 @@ interface LobbyStatus {
 }
 
 interface RestartStatus {
+    seq?: number;
     restart_count: number;
     total_count: number;
     players: { [name: string]: boolean };
 }
 
+// lobby_delta / restart_delta: one change since the status with seq - 1
+interface StatusDelta {
+    seq: number;
+    join?: string;
+    leave?: string;
+    ready?: string;
+    restart?: string;
+}
+
+const applyDelta = (players: { [name: string]: boolean }, delta: StatusDelta, flag: 'ready' | 'restart') => {
+    const next = { ...players };
+    if (delta.leave !== undefined) {
+        delete next[delta.leave];
+    }
+    if (delta.join !== undefined) {
+        next[delta.join] = next[delta.join] ?? false;
+    }
+    const flagged = delta[flag];
+    if (flagged !== undefined) {
+        next[flagged] = true;
+    }
+    const values = Object.values(next);
+    return { players: next, total_count: values.length, count: values.filter(Boolean).length };
+};
+
 interface GameOverData {
     winner: string;
     mafia: string[];
@@ -46,7 +73,12 @@ export const useGameSocket = (
     const [restartStatus, setRestartStatus] = useState<RestartStatus | null>(null);
     const [gameOverData, setGameOverData] = useState<GameOverData | null>(null);
     const [gameStage, setGameStage] = useState<string | null>(null);
-    const hasSetupRef = useRef(false);
+    // Resume token from id_registered; sent with setup after a reconnect to keep our seat
+    const resumeTokenRef = useRef<string | null>(null);
+    // Lobby/restart status arrives as one full status and then deltas; keep the latest to apply them to
+    const statusSeqRef = useRef<number>(0);
+    const lobbyStatusRef = useRef<LobbyStatus | null>(null);
+    const restartStatusRef = useRef<RestartStatus | null>(null);
     const reconnectTimeoutRef = useRef<NodeJS.Timeout | null>(null);
 
     const setCurrentHead = (position: string) => {
@@ -82,12 +114,17 @@ export const useGameSocket = (
                     console.log('[Game] Connected to Python game server');
                     onStatusChange('Connected to game server!');
 
-                    if (!hasSetupRef.current) {
-                        const setupMsg = { action: 'setup', target: playerName };
-                        gameSocketRef.current?.send(JSON.stringify(setupMsg));
-                        console.log('[Game] Sent setup signal');
-                        hasSetupRef.current = true;
-                    }
+                    // Tables are separated by room; ?room=<id> picks one, otherwise the default room
+                    const room = new URLSearchParams(window.location.search).get('room') ?? 'default';
+                    const setupMsg = {
+                        action: 'setup',
+                        target: playerName,
+                        room,
+                        deltas: true,
+                        ...(resumeTokenRef.current ? { resume: resumeTokenRef.current } : {})
+                    };
+                    gameSocketRef.current?.send(JSON.stringify(setupMsg));
+                    console.log(resumeTokenRef.current ? '[Game] Sent setup signal (resuming)' : '[Game] Sent setup signal');
                 };
 
                 gameSocketRef.current.onmessage = (event: MessageEvent) => {
@@ -96,11 +133,26 @@ export const useGameSocket = (
 
                     if (data.action === 'id_registered') {
                         console.log(`[Game] Player registered: ${data.player}`);
+                        resumeTokenRef.current = data.target?.token ?? null;
                         setPlayerId(data.player);
                         onStatusChange(`Registered as Player ${data.player}. Waiting in lobby...`);
                     }
 
+                    // Reconnected within the grace window: same seat, only our own state is sent
+                    if (data.action === 'resumed') {
+                        console.log('[Game] Resumed seat:', data.target);
+                        resumeTokenRef.current = data.target.token;
+                        setPlayerId(data.player);
+                        setGameStage(data.target.state);
+                        if (data.target.state !== 'LOBBY') {
+                            setRole(data.target.role);
+                        }
+                        onStatusChange(`Reconnected as Player ${data.player}`);
+                    }
+
                     if (data.action === 'lobby_status') {
+                        statusSeqRef.current = data.target.seq ?? 0;
+                        lobbyStatusRef.current = data.target;
                         setLobbyStatus(data.target);
                         const { ready_count, total_count, min_players } = data.target;
                         onStatusChange(
@@ -113,7 +165,34 @@ export const useGameSocket = (
                         onStatusChange(data.target);
                     }
 
+                    if (data.action === 'lobby_delta' || data.action === 'restart_delta') {
+                        const delta: StatusDelta = data.target;
+                        if (delta.seq !== statusSeqRef.current + 1) {
+                            // Missed an update: ask for the full status again
+                            console.log('[Game] Status gap, resyncing:', statusSeqRef.current, delta.seq);
+                            gameSocketRef.current?.send(JSON.stringify({ action: 'resync', target: null }));
+                            return;
+                        }
+                        statusSeqRef.current = delta.seq;
+                        if (data.action === 'lobby_delta' && lobbyStatusRef.current) {
+                            const { players, total_count, count } = applyDelta(lobbyStatusRef.current.players, delta, 'ready');
+                            const next = { ...lobbyStatusRef.current, seq: delta.seq, players, total_count, ready_count: count };
+                            lobbyStatusRef.current = next;
+                            setLobbyStatus(next);
+                            onStatusChange(`Lobby: ${count}/${total_count} ready (min: ${next.min_players})`);
+                        }
+                        if (data.action === 'restart_delta' && restartStatusRef.current) {
+                            const { players, total_count, count } = applyDelta(restartStatusRef.current.players, delta, 'restart');
+                            const next = { ...restartStatusRef.current, seq: delta.seq, players, total_count, restart_count: count };
+                            restartStatusRef.current = next;
+                            setRestartStatus(next);
+                            onStatusChange(`Restart: ${count}/${total_count} want to play again`);
+                        }
+                    }
+
                     if (data.action === 'restart_status') {
+                        statusSeqRef.current = data.target.seq ?? 0;
+                        restartStatusRef.current = data.target;
                         setRestartStatus(data.target);
                         const { restart_count, total_count } = data.target;
                         onStatusChange(
@@ -125,6 +204,7 @@ export const useGameSocket = (
                         setRole(data.action);
                         setGameOverData(null); // Reset game over data when new game starts
                         setRestartStatus(null);
+                        restartStatusRef.current = null;
                         console.log(`[Game] Role: ${data.action}`);
                         onStatusChange(`You are ${data.player} - Role: ${data.action.toUpperCase()}`);
                     }
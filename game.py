@@ -0,0 +1,974 @@
+import math
+import os
+import random
+import secrets
+import time
+from collections import Counter
+from dataclasses import asdict
+from typing import Callable, Collection, Dict, List
+from websockets.legacy.server import WebSocketServerProtocol
+from player import Player, Head, Role
+from log import get_logger, DEBUG_STATUS
+from protocol import BINARY, encode_binary
+from outbound import Outbox
+from registry import BROWSER, RPI, Connection, ConnectionRegistry
+from util import encode_body, encode_frame
+from journal import Journal
+from recorder import Recording
+from metrics import UPDATE_SECONDS, STATE_SECONDS
+from timerwheel import Timer, TimerWheel
+
+MAX_PLAYERS = 8
+DEFAULT_ROOM = "default"
+
+log = get_logger("game")
+
+
+def parse_deadlines(spec: str, states: Collection[str]) -> Dict[str, float]:
+    """
+    @param spec: e.g. "MAFIAVOTE=60,DOCTORVOTE=60,VOTE=120"
+    @param states: states with a deadline transition
+
+    Entries for other states, or without a positive number of seconds, are logged and skipped
+    """
+    deadlines = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        state, _, seconds = item.partition("=")
+        state = state.strip().upper()
+        if state not in states:
+            log.warning("Ignoring deadline for %s: only %s can time out", state, ", ".join(sorted(states)))
+            continue
+        try:
+            value = float(seconds)
+        except ValueError:
+            value = math.nan
+        if not (math.isfinite(value) and value > 0):
+            log.warning("Ignoring deadline for %s: %r is not a positive number of seconds", state, seconds)
+            continue
+        deadlines[state] = value
+    return deadlines
+
+# Internal update event: re-check the state that was just entered
+ADVANCE = "advance"
+
+class MafiaGame:
+    
+    async def broadcast_status(self, message: str):
+        # Send a status message to all players
+        await self.broadcast("status", message)
+
+    async def announce(self, message: str):
+        """Log a game event and show it to every player as a status message"""
+        self.log.info(message)
+        await self.broadcast_status(message)
+
+    async def debug_status(self, message: str, *args):
+        """Debug-only step; only reaches players when MAFIA_DEBUG_STATUS=1"""
+        self.log.debug(message, *args)
+        if DEBUG_STATUS:
+            await self.broadcast_status(message % args)
+
+    def __init__(self, room_id: str = DEFAULT_ROOM, journal: Journal | None = None):
+        self.room_id = room_id
+        self.log = get_logger("game", room_id)
+        self.journal = journal  # None: inputs aren't recorded (replay, benchmarks)
+        self.recording: Recording | None = None  # set by the room when MAFIA_RECORD_DIR is on
+        # Phase deadlines run on the room's shared timer wheel; without one (replay,
+        # benchmarks) phases wait for their players as before
+        self.timers: TimerWheel | None = None
+        self.on_deadline: Callable[[str, int], None] | None = None
+        self.deadline: Timer | None = None
+        # Role draws. Seeded explicitly so the journal can reproduce them;
+        # snapshots carry the full generator state.
+        self.rng = random.Random()
+        self.reseed(secrets.randbits(64))
+        self.state = "LOBBY"
+        self.expected_signals = EXPECTED_SIGNALS[self.state]
+        self.state_entered_at = time.monotonic()
+        self.transition_count = 0
+        self.max_players = MAX_PLAYERS
+
+        self.players: Dict[str, Player] = {}  # name -> player data
+        self.connections = ConnectionRegistry()  # browsers and rpis, with their outboxes
+        # Lobby/restart status is versioned; clients that opt in at setup get one
+        # full status and then only the changes, each with the next seq number
+        self.status_seq = 0
+        
+        self.player_id_to_name: Dict[int, str] = {}  # player_id -> name
+        self.name_to_player_id: Dict[str, int] = {}  # name -> player_id
+        # IDs are never reused in a room, so a binary target can't hit whoever took a leaver's seat
+        self.next_player_id = 1
+        
+        self.mafia_name_one = None
+        self.mafia_name_two = None
+        self.doctor_name_one = None
+        self.doctor_name_two = None
+        
+        self.last_killed = None
+        self.last_saved = None
+        self.mafia_count = None
+        self.doctor_count = None
+        self.game_winner = None
+        self.pending_code = -1
+
+        # Running counters, kept in step with player fields by the setters below
+        self.ready_count = 0
+        self.restart_count = 0
+        self.alive_count = 0
+        self.alive_heads_up = 0  # alive players with their head up
+        self.votes_cast = 0  # alive players holding a vote
+        self.vote_tally: Counter = Counter()  # target -> votes from alive players
+
+    def valid_signal(self, action: str) -> bool:
+        return action in self.expected_signals
+
+    # ---- player bookkeeping: every change to a counted field goes through here ----
+
+    def _count(self, player: Player, sign: int):
+        """Add (sign=1) or remove (sign=-1) one player's share of the running counters"""
+        if player.ready:
+            self.ready_count += sign
+        if player.restart:
+            self.restart_count += sign
+        if player.alive:
+            self.alive_count += sign
+            if player.head is Head.UP:
+                self.alive_heads_up += sign
+            if player.vote is not None:
+                self.votes_cast += sign
+            if player.vote:
+                self.vote_tally[player.vote] += sign
+                if self.vote_tally[player.vote] <= 0:
+                    del self.vote_tally[player.vote]
+
+    def _set_field(self, name: str, field: str, value):
+        player = self.players[name]
+        self._count(player, -1)
+        setattr(player, field, value)
+        self._count(player, 1)
+
+    def add_player(self, name: str, player_id: int, token: str = ""):
+        """Register a new seat (NOT ready by default)"""
+        self.player_id_to_name[player_id] = name
+        self.name_to_player_id[name] = player_id
+        self.next_player_id = max(self.next_player_id, player_id + 1)
+        self.players[name] = Player(name, player_id, token=token)
+        self._count(self.players[name], 1)
+
+    def remove_player(self, name: str):
+        player_id = self.name_to_player_id.get(name)
+        if player_id is not None:
+            del self.player_id_to_name[player_id]
+            del self.name_to_player_id[name]
+        self._count(self.players.pop(name), -1)
+
+    def set_ready(self, name: str, ready: bool = True):
+        self._set_field(name, "ready", ready)
+
+    def set_restart(self, name: str, restart: bool = True):
+        self._set_field(name, "restart", restart)
+
+    def set_head(self, name: str, head: Head):
+        self._set_field(name, "head", head)
+
+    def set_vote(self, name: str, target):
+        self._set_field(name, "vote", target)
+
+    def set_alive(self, name: str, alive: bool):
+        self._set_field(name, "alive", alive)
+
+    def recount(self):
+        """Rebuild every counter from scratch after a bulk change"""
+        self.ready_count = self.restart_count = self.alive_count = 0
+        self.alive_heads_up = self.votes_cast = 0
+        self.vote_tally.clear()
+        for player in self.players.values():
+            self._count(player, 1)
+
+    # ---- player inputs: each is journaled first, so a restart can replay it ----
+
+    def record(self, kind: str, *args):
+        if self.journal is not None:
+            self.journal.append(self.room_id, kind, args)
+
+    def reseed(self, seed: int):
+        self.record("seed", seed)
+        self.seed = seed
+        self.rng.seed(seed)
+
+    async def replay(self, kind: str, args: list):
+        """Apply one journal entry during recovery"""
+        if kind == "state":
+            # Transitions are only checked: the inputs before them already redid them
+            state, count = args
+            if count > self.transition_count or (count == self.transition_count and state != self.state):
+                self.log.warning("Replay diverged: journal has %s (#%d), game is in %s (#%d)",
+                                 state, count, self.state, self.transition_count)
+            return
+        if kind == "seed":
+            self.reseed(*args)
+            return
+        await INPUTS[kind](self, *args)
+
+    async def input_join(self, name: str, player_id: int, token: str | None = None):
+        token = token or secrets.token_urlsafe(16)
+        self.record("join", name, player_id, token)
+        self.add_player(name, player_id, token)
+
+    async def input_leave(self, name: str):
+        self.record("leave", name)
+        self.remove_player(name)
+        self.check_role_counts()
+        # Broadcast updated lobby status if still in lobby
+        if self.state == "LOBBY":
+            await self.broadcast_lobby_status({"leave": name})
+        elif self.state == "GAMEOVER":
+            await self.broadcast_restart_status({"leave": name})
+
+    async def input_ready(self, name: str):
+        self.record("ready", name)
+        self.set_ready(name)
+        # Broadcast updated lobby status, then try to start the game
+        await self.broadcast_lobby_status({"ready": name})
+        await self.update("ready")
+
+    async def input_restart(self, name: str):
+        self.record("restart", name)
+        self.set_restart(name)
+        # Broadcast updated restart status, then try to restart the game
+        await self.broadcast_restart_status({"restart": name})
+        await self.update("restart")
+
+    async def input_deadline(self, state: str, transition_count: int) -> bool:
+        """A phase ran out of time. Ignored (returns False) if the room moved on since it was armed."""
+        if (self.state, self.transition_count) != (state, transition_count):
+            return False
+        self.record("deadline", state, transition_count)
+        self.deadline = None
+        await self.update("deadline")
+        return True
+
+    async def input_voice(self, code):
+        self.record("voice", code)
+        self.pending_code = code
+        await self.update("voiceCommand")
+
+    async def input_head(self, name: str, head: Head):
+        head = Head(head)
+        self.record("head", name, head.value)
+        self.set_head(name, head)
+        await self.update("headUp" if head is Head.UP else "headDown")
+
+    async def input_target(self, name: str, target):
+        """A kill, save or vote, depending on who sent it and when"""
+        self.record("target", name, target)
+        player = self.players[name]
+        if (name == self.mafia_name_one or name == self.mafia_name_two) and self.state == "MAFIAVOTE":
+            player.kill = target
+            self.log.debug("%s voted to kill: %s", name, target)
+        elif (name == self.doctor_name_one or name == self.doctor_name_two) and self.state == "DOCTORVOTE":
+            player.save = target
+            self.log.debug("%s voted to save: %s", name, target)
+        else:
+            self.set_vote(name, target)
+            self.log.debug("%s voted for: %s", name, target)
+        await self.update("targeted")
+
+    # ---- snapshots ----
+
+    def to_snapshot(self) -> dict:
+        """Everything needed to rebuild this game without its connections"""
+        data = {field: getattr(self, field) for field in SNAPSHOT_FIELDS}
+        data["players"] = [dict(asdict(player), head=player.head.value, role=player.role.value)
+                           for player in self.players.values()]
+        data["rng"] = self.rng.getstate()
+        data["next_player_id"] = self.next_player_id
+        # Only read by recovery, to know which devices to hold each seat for
+        devices: Dict[str, List[str]] = {}
+        for name, device in self.connections.by_player:
+            devices.setdefault(name, []).append(device)
+        data["devices"] = devices
+        return data
+
+    @classmethod
+    def from_snapshot(cls, room_id: str, data: dict) -> "MafiaGame":
+        game = cls(room_id)
+        for field in SNAPSHOT_FIELDS:
+            setattr(game, field, data[field])
+        for fields in data["players"]:
+            player = Player(**dict(fields, head=Head(fields["head"]), role=Role(fields["role"])))
+            game.players[player.name] = player
+            game.player_id_to_name[player.player_id] = player.name
+            game.name_to_player_id[player.name] = player.player_id
+        # Snapshots from before IDs were counted only know the seated players
+        game.next_player_id = max(data.get("next_player_id", 1), max(game.player_id_to_name, default=0) + 1)
+        version, internal, gauss = data["rng"]
+        game.rng.setstate((version, tuple(internal), gauss))
+        game.expected_signals = EXPECTED_SIGNALS[game.state]
+        game.recount()
+        return game
+
+    @classmethod
+    def adopt(cls, old: "MafiaGame") -> "MafiaGame":
+        """
+        @param old: a live game, possibly an instance of the class before a hot reload
+
+        Rebuilds the game through a snapshot and hands over what snapshots leave
+        out (connections, timers, journal), so players stay connected.
+        """
+        game = cls.from_snapshot(old.room_id, old.to_snapshot())
+        for field in RUNTIME_FIELDS:
+            setattr(game, field, getattr(old, field))
+        return game
+
+    def check_everyone_ready(self):
+        """Check if all players are ready to start (minimum 3 players)"""
+        if len(self.players) < 3:
+            return False
+        return self.ready_count == len(self.players)
+    
+    def check_everyone_wants_restart(self):
+        """Check if all players want to restart"""
+        if len(self.players) == 0:
+            return False
+        return self.restart_count == len(self.players)
+
+    def check_game_over(self):
+        """Check if game is over and determine winner"""
+        # Check if any mafia are alive
+        mafia_alive = self.is_alive(self.mafia_name_one) or self.is_alive(self.mafia_name_two)
+        # If no mafia alive, civilians win
+        if not mafia_alive:
+            return "civilians"
+        
+        # If mafia >= civilians (non-mafia), mafia wins
+        alive_mafia_count = sum([
+            1 if self.is_alive(self.mafia_name_one) else 0,
+            1 if self.is_alive(self.mafia_name_two) else 0
+        ])
+        alive_civilians = self.alive_count - alive_mafia_count
+        
+        if alive_mafia_count >= alive_civilians:
+            return "mafia"
+        
+        return None  # Game continues
+
+    def reset_game_state(self):
+        """Reset game state for a new round while keeping players"""
+        self.log.debug("Resetting game state for new round...")
+        
+        # Reset all player states
+        for player in self.players.values():
+            player.reset_for_new_round()
+        self.recount()
+        self.connections.set_roles(self.role_of)
+        
+        # Reset game variables
+        self.mafia_name_one = None
+        self.mafia_name_two = None
+        self.doctor_name_one = None
+        self.doctor_name_two = None
+        self.last_killed = None
+        self.last_saved = None
+        self.mafia_count = None
+        self.doctor_count = None
+        self.game_winner = None
+        self.pending_code = -1
+        
+        # Back to lobby
+        self.set_state("LOBBY")
+        
+        self.log.debug("Game state reset complete")
+
+    def check_heads_down(self, allowed: List[str | None]):
+        """True when every alive player outside `allowed` has their head down"""
+        allowed_up = sum(1 for name in set(allowed)
+                         if self.is_alive(name) and self.players[name].head is Head.UP)
+        return self.alive_heads_up - allowed_up == 0
+
+    async def request_action(self, name: str, action: str):
+        await self.request_actions([name], action)
+
+    async def request_actions(self, names: List[str | None], action: str):
+        """Ask several players' rpis for the same action at once"""
+        self.log.debug("Requesting %s from %s", action, names)
+        body = encode_body(action, None)
+        rpis = (self.connections.of(name, RPI) for name in names if name is not None)
+        await self.deliver([(conn, self.rpi_frame(conn, action, body)) for conn in rpis if conn is not None])
+
+    def rpi_frame(self, conn: Connection, action: str, body: str):
+        """A 3-byte binary frame if this Pi negotiated it, the JSON frame otherwise"""
+        if conn.binary:
+            frame = encode_binary(action, self.name_to_player_id.get(conn.name, 0))
+            if frame is not None:
+                return frame
+        return encode_frame(conn.name, body)
+
+    def open_connection(self, ws: WebSocketServerProtocol) -> Connection:
+        """The connection's registry entry (and send queue), created at its first setup"""
+        return self.connections.get(ws) or self.connections.open(ws, Outbox(ws))
+
+    async def deliver(self, messages, droppable: bool = False):
+        """
+        Queue (connection, frame) pairs on each connection's outbox and return right away.
+        Each outbox's writer does the network I/O and evicts clients that fall behind.
+        """
+        recording = self.recording
+        for conn, frame in messages:
+            if recording is not None:
+                recording.outbound(conn.ws, frame)
+            conn.outbox.put(frame, droppable)
+
+    async def send_to(self, ws: WebSocketServerProtocol, player, action: str, target=None):
+        """Queue one JSON message for a single connection"""
+        conn = self.connections.get(ws)
+        if conn is None:
+            self.log.warning("No outbox for %s, dropping frame", ws.remote_address)
+            return
+        await self.deliver([(conn, encode_frame(player, encode_body(action, target)))])
+
+    def registration(self, name: str, binary: bool = False) -> dict:
+        """id_registered payload: the resume token, plus the protocol ack for binary Pis"""
+        registered = {"token": self.players[name].token}
+        if binary:
+            registered["protocol"] = BINARY
+        return registered
+
+    def attach(self, ws: WebSocketServerProtocol, name: str, device: str, binary: bool = False) -> WebSocketServerProtocol | None:
+        """
+        Make an open connection this player's browser or rpi, e.g. at registration or on resume.
+        Returns the connection it replaced, if that one is still open.
+        """
+        self.connections.get(ws).binary = binary
+        old = self.connections.attach(ws, name, device, self.role_of(name))
+        return old.ws if old is not None else None
+
+    def catch_up(self, name: str, binary: bool = False) -> dict:
+        """Everything a resumed player needs about their own seat, instead of a full re-registration"""
+        player = self.players[name]
+        state = self.registration(name, binary)
+        state.update({
+            "state": self.state,
+            "role": player.role.value,
+            "alive": player.alive,
+            "ready": player.ready,
+            "restart": player.restart,
+            "vote": player.vote,
+        })
+        return state
+
+    def pending_request(self, name: str) -> str | None:
+        """The kill/save/vote request this player still owes an answer to, if any"""
+        player = self.players[name]
+        if not player.alive:
+            return None
+        if self.state == "MAFIAVOTE" and player.role is Role.MAFIA and player.kill is None:
+            return "kill"
+        if self.state == "DOCTORVOTE" and player.role is Role.DOCTOR and player.save is None:
+            return "save"
+        if self.state == "VOTE" and player.vote is None:
+            return "vote"
+        return None
+
+    def id_to_name(self, player_id: int) -> str | None:
+        """Convert a player ID to player name"""
+        return self.player_id_to_name.get(player_id)
+
+    def name_to_id(self, name: str) -> int | None:
+        """Convert a player name to player ID"""
+        return self.name_to_player_id.get(name)
+
+    def mafia_kill(self):
+        if self.mafia_count == 1:
+            if self.is_alive(self.mafia_name_one) and self.players[self.mafia_name_one].kill:
+                kill = self.players[self.mafia_name_one].kill
+                self.players[self.mafia_name_one].kill = None
+                return kill
+            elif self.is_alive(self.mafia_name_two) and self.players[self.mafia_name_two].kill:
+                    kill = self.players[self.mafia_name_two].kill
+                    self.players[self.mafia_name_two].kill = None
+                    return kill
+            return None
+        elif self.mafia_count == 2:
+            if self.is_alive(self.mafia_name_one) and self.players[self.mafia_name_one].kill and self.is_alive(self.mafia_name_two) and self.players[self.mafia_name_two].kill:
+                if self.players[self.mafia_name_one].kill == self.players[self.mafia_name_two].kill:
+                    kill = self.players[self.mafia_name_one].kill
+                    self.players[self.mafia_name_one].kill = None
+                    self.players[self.mafia_name_two].kill = None
+                    return kill
+            return None
+
+    def doctor_save(self):
+        if self.doctor_count == 1:
+            if self.is_alive(self.doctor_name_one) and self.players[self.doctor_name_one].save:
+                save = self.players[self.doctor_name_one].save
+                self.players[self.doctor_name_one].save = None
+                return save
+            elif self.is_alive(self.doctor_name_two) and self.players[self.doctor_name_two].save:
+                save = self.players[self.doctor_name_two].save
+                self.players[self.doctor_name_two].save = None
+                return save
+            return None
+        elif self.doctor_count == 2:
+            if self.is_alive(self.doctor_name_one) and self.players[self.doctor_name_one].save and self.is_alive(self.doctor_name_two) and self.players[self.doctor_name_two].save:
+                if self.players[self.doctor_name_one].save == self.players[self.doctor_name_two].save:
+                    save = self.players[self.doctor_name_one].save
+                    self.players[self.doctor_name_one].save = None
+                    self.players[self.doctor_name_two].save = None
+                    return save
+            return None
+
+    def everyone_voted(self):
+        return self.votes_cast == self.alive_count
+
+    def handle_vote(self):
+        votes = self.vote_tally
+        if not votes:
+            return []
+
+        max_votes = max(votes.values())
+        winners = [name for name, count in votes.items() if count == max_votes]
+
+        # Clear votes
+        for player in self.players.values():
+            player.vote = None
+        self.votes_cast = 0
+        self.vote_tally = Counter()
+
+        return winners
+
+    def check_role_counts(self):
+        if self.mafia_count == 2:
+            if self.is_alive(self.mafia_name_one) == False or self.is_alive(self.mafia_name_two) == False:
+                self.mafia_count = 1
+        if self.doctor_count == 2:
+            if self.is_alive(self.doctor_name_one) == False or self.is_alive(self.doctor_name_two) == False:
+                self.doctor_count = 1
+
+    def is_alive(self, name: str | None) -> bool:
+        return bool(name) and name in self.players and self.players[name].alive
+
+    async def broadcast(self, action, target=None):
+        # Encode the shared payload once; only the player envelope differs per client
+        body = encode_body(action, target)
+        # Status chatter is the first thing a backed-up outbox sheds
+        await self.deliver([(conn, encode_frame(conn.name, body)) for conn in self.connections.devices(BROWSER)],
+                           droppable=action == "status")
+
+    def lobby_status(self) -> dict:
+        return {
+            "seq": self.status_seq,
+            "ready_count": self.ready_count,
+            "total_count": len(self.players),
+            "min_players": 3,
+            "max_players": self.max_players,
+            "players": {
+                pname: pdata.ready
+                for pname, pdata in self.players.items()
+            }
+        }
+
+    def restart_status(self) -> dict:
+        return {
+            "seq": self.status_seq,
+            "restart_count": self.restart_count,
+            "total_count": len(self.players),
+            "players": {
+                pname: pdata.restart
+                for pname, pdata in self.players.items()
+            }
+        }
+
+    async def broadcast_lobby_status(self, change: dict | None = None):
+        """
+        @param change: what just changed, e.g. {"ready": name}; None sends everyone a full status
+
+        Broadcast current lobby status to all players
+        """
+        await self.broadcast_versioned("lobby_status", "lobby_delta", self.lobby_status, change)
+
+    async def broadcast_restart_status(self, change: dict | None = None):
+        """Broadcast restart status to all players (change as for broadcast_lobby_status)"""
+        await self.broadcast_versioned("restart_status", "restart_delta", self.restart_status, change)
+
+    async def broadcast_versioned(self, action: str, delta_action: str, status, change: dict | None):
+        """
+        Bumps the status seq and sends a delta to opted-in clients that hold the
+        previous status of the same kind, and the full status to everyone else
+        (e.g. a lobby change during GAMEOVER). Each body is encoded at most once.
+        """
+        self.status_seq += 1
+        full = delta = None
+        messages = []
+        for conn in self.connections.devices(BROWSER):
+            if change is not None and conn.synced == action:
+                if delta is None:
+                    delta = encode_body(delta_action, {"seq": self.status_seq, **change})
+                messages.append((conn, encode_frame(conn.name, delta)))
+                continue
+            if full is None:
+                full = encode_body(action, status())
+            messages.append((conn, encode_frame(conn.name, full)))
+            conn.synced = action if conn.deltas else None
+        await self.deliver(messages)
+
+    async def send_status(self, ws: WebSocketServerProtocol):
+        """Full lobby or restart status for one client, e.g. one that saw a gap in the seq numbers"""
+        conn = self.connections.get(ws)
+        if conn is None or conn.device != BROWSER or self.state not in ("LOBBY", "GAMEOVER"):
+            return
+        if self.state == "LOBBY":
+            action, status = "lobby_status", self.lobby_status()
+        else:
+            action, status = "restart_status", self.restart_status()
+        conn.synced = action if conn.deltas else None
+        await self.send_to(ws, conn.name, action, status)
+
+    def forget_connection(self, ws: WebSocketServerProtocol):
+        """Drop a closed or replaced connection and stop its send queue"""
+        conn = self.connections.remove(ws)
+        if conn is not None:
+            conn.outbox.close()
+
+    async def broadcast_vote(self):
+        await self.request_actions(self.connections.names(RPI), "vote")
+
+    async def broadcast_game_end(self, winner: str):
+        await self.broadcast(winner, None)
+
+    def role_of(self, name: str) -> Role:
+        player = self.players.get(name)
+        return player.role if player else Role.CIVILIAN
+
+    async def assign_player(self):
+        # One body per role, sent straight to that role's connections
+        messages = []
+        for role in Role:
+            body = encode_body(role.value, None)
+            messages += [(conn, encode_frame(conn.name, body)) for conn in self.connections.with_role(role, BROWSER)]
+            messages += [(conn, self.rpi_frame(conn, role.value, body)) for conn in self.connections.with_role(role, RPI)]
+        await self.deliver(messages)
+
+    def set_state(self, state: str):
+        """Move to a new state, recording how long the room spent in the old one"""
+        now = time.monotonic()
+        elapsed = now - self.state_entered_at
+        STATE_SECONDS.inc(self.state, amount=elapsed)
+        self.log.debug("Leaving %s after %.2fs", self.state, elapsed)
+        self.state = state
+        self.state_entered_at = now
+        self.transition_count += 1
+        self.record("state", state, self.transition_count)
+        self.expected_signals = EXPECTED_SIGNALS[state]
+        self.arm_deadline()
+
+    def arm_deadline(self):
+        """Start the current phase's deadline, replacing the last phase's"""
+        self.cancel_deadline()
+        seconds = PHASE_DEADLINES.get(self.state)
+        if seconds and self.timers is not None and self.on_deadline is not None:
+            self.deadline = self.timers.schedule(seconds, self.on_deadline, self.state, self.transition_count)
+
+    def cancel_deadline(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+
+    async def update(self, event: str = ADVANCE):
+        """
+        Run the state machine until it settles. `event` is the player action that
+        triggered the update; after every transition the new state is re-checked
+        with ADVANCE until a step waits for input or no transition applies.
+        """
+        with UPDATE_SECONDS.time(event):
+            while True:
+                step = TRANSITIONS.get((self.state, event))
+                if step is None:
+                    return
+                state_before = self.state
+                wait_for_input = await step(self)
+                if wait_for_input or self.state == state_before:
+                    return
+                await self.debug_status("State changed from %s to %s, continuing update...", state_before, self.state)
+                event = ADVANCE
+
+    # Each step handles one state. Returning True means the room is now waiting
+    # on players, so the update loop stops even though the state changed.
+
+    async def step_lobby(self):
+        if not self.check_everyone_ready():
+            return
+        await self.announce(f"All {len(self.players)} players ready! Starting game...")
+        if self.pending_code == 2:
+            self.pending_code = -1
+            # Assign roles randomly based on player count
+            player_names = list(self.players.keys())
+            num_players = len(player_names)
+        
+            if num_players >= 7:
+                self.mafia_count = 2
+                self.doctor_count = 2
+                self.mafia_name_one, self.mafia_name_two, self.doctor_name_one, self.doctor_name_two = self.rng.sample(player_names, 4)
+            else:
+                self.mafia_count = 1
+                self.doctor_count = 1
+                self.mafia_name_one, self.doctor_name_one = self.rng.sample(player_names, 2)
+            for name in (self.mafia_name_one, self.mafia_name_two):
+                if name is not None:
+                    self.players[name].role = Role.MAFIA
+            for name in (self.doctor_name_one, self.doctor_name_two):
+                if name is not None:
+                    self.players[name].role = Role.DOCTOR
+            self.connections.set_roles(self.role_of)
+            
+            await self.announce(f"Assigned roles: Mafia={self.mafia_count}, Doctor={self.doctor_count}")
+
+            self.set_state("ASSIGN")
+
+    async def step_assign(self):
+        await self.assign_player()
+        await self.broadcast("heads_down", None)
+        self.set_state("HEADSDOWN")
+        await self.announce("Moving on to mafia stage, everyone put head down please")
+
+    async def step_heads_down(self):
+        # and self.check_heads_down([])
+        self.set_state("MAFIAVOTE")
+        await self.announce("MOVING ON TO MAFIA VOTE STAGE")
+        if self.mafia_count == 1:
+            if self.players[self.mafia_name_one].alive == True:
+                await self.request_action(self.mafia_name_one, "kill")
+                return True
+            elif self.players[self.mafia_name_two].alive == True and self.mafia_name_two != None:
+                await self.request_action(self.mafia_name_two, "kill")
+                return True
+        elif self.mafia_count == 2:
+            await self.request_actions([self.mafia_name_one, self.mafia_name_two], "kill")
+            return True
+
+    async def step_mafia_vote(self):
+        # if self.check_heads_down([self.mafia_name_one, self.mafia_name_two]):
+        kill = self.mafia_kill()
+        if kill == None and self.mafia_count == 2 and self.players[self.mafia_name_one].kill != None and self.players[self.mafia_name_two].kill != None:
+            await self.announce("Mafia voted for different people, try again.")
+
+            self.players[self.mafia_name_one].kill = None
+            self.players[self.mafia_name_two].kill = None
+            await self.request_actions([self.mafia_name_one, self.mafia_name_two], "kill")
+            return True
+        if kill != None:
+            self.log.debug("Kill successful: %s", kill)
+            return await self.start_doctor_vote(kill)
+
+    async def start_doctor_vote(self, kill: str):
+        """The night's kill is settled: ask the doctors for a save, or narrate if none is alive"""
+        self.last_killed = kill
+        self.set_state("DOCTORVOTE" if (self.players[self.doctor_name_one].alive or (self.doctor_name_two != None and self.players[self.doctor_name_two].alive)) else "NARRATE")
+        if self.state == "DOCTORVOTE":
+            if self.doctor_count == 1:
+                if self.players[self.doctor_name_one].alive == True:
+                    await self.request_action(self.doctor_name_one, "save")
+                    return True
+                elif self.players[self.doctor_name_two].alive == True and self.doctor_name_two != None:
+                    await self.request_action(self.doctor_name_two, "save")
+                    return True
+            elif self.doctor_count == 2:
+                await self.request_actions([self.doctor_name_one, self.doctor_name_two], "save")
+                return True
+
+    async def step_doctor_vote(self):
+        # if self.check_heads_down([self.doctor_name_one, self.doctor_name_two]):
+        save = self.doctor_save()
+        if save == None and self.doctor_count == 2 and self.players[self.doctor_name_one].save != None and self.players[self.doctor_name_two].save != None:
+            await self.announce("Doctor voted for different people, try again.")
+            self.players[self.doctor_name_one].save = None
+            self.players[self.doctor_name_two].save = None
+            await self.request_actions([self.doctor_name_one, self.doctor_name_two], "save")
+            return True
+        if save != None:
+            await self.finish_doctor_vote(save)
+
+    async def finish_doctor_vote(self, save: str | None):
+        self.last_saved = save
+        if self.last_saved != self.last_killed:
+            await self.announce("Doctor save failed.")
+            self.set_alive(self.last_killed, False)
+            self.check_role_counts()
+        self.set_state("NARRATE")
+
+    # Deadline steps: the phase ran out of time, so it resolves with what it has
+
+    def take_picks(self, names, field: str) -> List[str]:
+        """The kill/save picks alive players made so far, in role order, clearing them"""
+        picks = []
+        for name in names:
+            if name is not None and name in self.players:
+                player = self.players[name]
+                if player.alive and getattr(player, field):
+                    picks.append(getattr(player, field))
+                setattr(player, field, None)
+        return picks
+
+    async def deadline_mafia_vote(self):
+        """The first mafia pick stands; with none, nobody is killed tonight"""
+        picks = self.take_picks((self.mafia_name_one, self.mafia_name_two), "kill")
+        await self.announce("Mafia ran out of time.")
+        if picks:
+            return await self.start_doctor_vote(picks[0])
+        self.last_killed = None
+        self.set_state("NARRATE")
+
+    async def deadline_doctor_vote(self):
+        """The first doctor pick stands; with none, the save fails"""
+        picks = self.take_picks((self.doctor_name_one, self.doctor_name_two), "save")
+        await self.announce("Doctor ran out of time.")
+        await self.finish_doctor_vote(picks[0] if picks else None)
+
+    async def deadline_vote(self):
+        """Count the votes cast so far; no votes counts as a tie"""
+        await self.announce("Voting time is up.")
+        return await self.resolve_vote()
+
+    async def step_narrate(self):
+        await self.announce("Narrating night results...")
+        await self.broadcast("night_result", {
+            "killed": self.last_killed,
+            "saved": self.last_saved
+        })
+        self.last_saved = None
+        self.last_killed = None
+        # Check if game is over after night
+        winner = self.check_game_over()
+        if winner:
+            self.game_winner = winner
+            self.set_state("GAMEOVER")
+            await self.broadcast("game_over", {
+                "winner": winner,
+                "mafia": [self.mafia_name_one, self.mafia_name_two] if self.mafia_count == 2 else [self.mafia_name_one]
+            })
+            await self.broadcast_restart_status()
+            return True
+        
+        self.set_state("PREVOTE")
+        await self.announce("Moving to day voting stage.")
+
+    async def step_prevote(self):
+        if self.pending_code == 3:
+            self.pending_code = -1
+            self.set_state("VOTE")
+            await self.broadcast_vote()
+
+    async def step_vote(self):
+        if not self.everyone_voted():
+            return
+        return await self.resolve_vote()
+
+    async def resolve_vote(self):
+        voted_out = self.handle_vote()
+        if len(voted_out) != 1:
+            await self.announce(f"Vote tied between {[player for player in voted_out]}")
+            await self.broadcast("vote_result_tie", voted_out)
+            self.set_state("HEADSDOWN")
+            await self.announce("Moving back to night phase.")
+            await self.broadcast("heads_down", None)
+            return True
+        
+        await self.announce(f"Player voted out: {voted_out[0]}")
+        self.set_alive(voted_out[0], False)
+        self.check_role_counts()
+        await self.broadcast("vote_result", voted_out)
+        
+        # Check if game is over after vote
+        winner = self.check_game_over()
+        if winner:
+            self.game_winner = winner
+            self.set_state("GAMEOVER")
+            await self.broadcast("game_over", {
+                "winner": winner,
+                "mafia": [self.mafia_name_one, self.mafia_name_two] if len(self.players) >= 7 else [self.mafia_name_one]
+            })
+            await self.broadcast_restart_status()
+            return True
+        
+        self.set_state("HEADSDOWN")
+        await self.announce("Moving back to night phase.")
+        await self.broadcast("heads_down", voted_out)
+
+    async def step_game_over(self):
+        if self.check_everyone_wants_restart():
+            await self.announce("All players want to restart! Restarting game...")
+            self.reset_game_state()
+            await self.broadcast_lobby_status()
+
+
+# Signals each state accepts from players
+EXPECTED_SIGNALS = {
+    "LOBBY": frozenset({"setup"}),
+    "ASSIGN": frozenset(),
+    "HEADSDOWN": frozenset({"headUp", "headDown"}),
+    "MAFIAVOTE": frozenset({"headUp", "headDown", "targeted"}),
+    "DOCTORVOTE": frozenset({"headUp", "headDown", "targeted"}),
+    "NARRATE": frozenset({"headUp", "headDown", "targeted"}),
+    "PREVOTE": frozenset({"targeted"}),
+    "VOTE": frozenset({"targeted"}),
+    "GAMEOVER": frozenset(),
+}
+
+# Fields of MafiaGame saved in snapshots, besides players and the RNG
+SNAPSHOT_FIELDS = (
+    "state", "transition_count", "max_players",
+    "mafia_name_one", "mafia_name_two", "doctor_name_one", "doctor_name_two",
+    "last_killed", "last_saved", "mafia_count", "doctor_count", "game_winner", "pending_code",
+)
+
+# Fields of MafiaGame that snapshots leave out, handed over as they are by adopt()
+RUNTIME_FIELDS = (
+    "journal", "recording", "timers", "on_deadline", "deadline", "seed",
+    "state_entered_at", "connections", "status_seq",
+)
+
+# Journal entry kind -> the input method that applies it
+INPUTS = {
+    "join": MafiaGame.input_join,
+    "leave": MafiaGame.input_leave,
+    "ready": MafiaGame.input_ready,
+    "restart": MafiaGame.input_restart,
+    "voice": MafiaGame.input_voice,
+    "head": MafiaGame.input_head,
+    "target": MafiaGame.input_target,
+    "deadline": MafiaGame.input_deadline,
+}
+
+# (state, event) -> step that may move the room forward. Pairs that are not
+# listed cannot change the state, so update() returns without doing anything.
+TRANSITIONS = {
+    ("LOBBY", "ready"): MafiaGame.step_lobby,
+    ("LOBBY", "voiceCommand"): MafiaGame.step_lobby,
+    ("LOBBY", ADVANCE): MafiaGame.step_lobby,
+    ("ASSIGN", ADVANCE): MafiaGame.step_assign,
+    ("HEADSDOWN", "headUp"): MafiaGame.step_heads_down,
+    ("HEADSDOWN", "headDown"): MafiaGame.step_heads_down,
+    ("HEADSDOWN", "voiceCommand"): MafiaGame.step_heads_down,
+    ("HEADSDOWN", ADVANCE): MafiaGame.step_heads_down,
+    ("MAFIAVOTE", "headUp"): MafiaGame.step_mafia_vote,
+    ("MAFIAVOTE", "headDown"): MafiaGame.step_mafia_vote,
+    ("MAFIAVOTE", "targeted"): MafiaGame.step_mafia_vote,
+    ("MAFIAVOTE", "deadline"): MafiaGame.deadline_mafia_vote,
+    ("DOCTORVOTE", "headUp"): MafiaGame.step_doctor_vote,
+    ("DOCTORVOTE", "headDown"): MafiaGame.step_doctor_vote,
+    ("DOCTORVOTE", "targeted"): MafiaGame.step_doctor_vote,
+    ("DOCTORVOTE", "deadline"): MafiaGame.deadline_doctor_vote,
+    ("NARRATE", ADVANCE): MafiaGame.step_narrate,
+    ("PREVOTE", "voiceCommand"): MafiaGame.step_prevote,
+    ("PREVOTE", ADVANCE): MafiaGame.step_prevote,
+    ("VOTE", "targeted"): MafiaGame.step_vote,
+    ("VOTE", ADVANCE): MafiaGame.step_vote,
+    ("VOTE", "deadline"): MafiaGame.deadline_vote,
+    ("GAMEOVER", "restart"): MafiaGame.step_game_over,
+}
+
+# Seconds a vote phase waits for its players before resolving with a default
+# outcome, so one unresponsive pi can't stall the table. Off unless set, e.g.
+# "MAFIAVOTE=60,DOCTORVOTE=60,VOTE=120"; a phase left out waits forever.
+PHASE_DEADLINES = parse_deadlines(
+    os.environ.get("MAFIA_PHASE_DEADLINES", ""), {state for state, event in TRANSITIONS if event == "deadline"})
@@ -0,0 +1,164 @@
+import glob
+import os
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from codec import codec
+from log import get_logger
+
+# Directory for the journal and snapshots; empty turns journaling off
+JOURNAL_DIR = os.environ.get("MAFIA_JOURNAL_DIR", "")
+# Seconds the writer thread waits to gather more entries into one fsync
+FSYNC_INTERVAL = float(os.environ.get("MAFIA_JOURNAL_FSYNC", "0.05"))
+# A snapshot is taken this often, or sooner once the log tail reaches MAX_TAIL entries,
+# so recovery never replays more than a bounded tail
+SNAPSHOT_INTERVAL = float(os.environ.get("MAFIA_SNAPSHOT_INTERVAL", "60"))
+MAX_TAIL = int(os.environ.get("MAFIA_SNAPSHOT_ENTRIES", "5000"))
+
+SNAPSHOT_FILE = "snapshot.json"
+
+log = get_logger("journal")
+
+
+def _segment_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f"journal-{segment:08d}.log")
+
+
+def _segments(directory: str) -> List[int]:
+    paths = glob.glob(os.path.join(directory, "journal-*.log"))
+    return sorted(int(os.path.basename(path)[8:16]) for path in paths)
+
+
+def _fsync_dir(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """
+    Append-only log of every accepted player input and state transition, one
+    compact JSON array per line: [room_id, kind, *args].
+
+    append() only enqueues; a writer thread batches entries, writes them and
+    fsyncs off the event loop. snapshot() starts a new log segment, so the
+    snapshot plus the segments after it are always enough to rebuild every room.
+    """
+    def __init__(self, directory: str = JOURNAL_DIR, fsync_interval: float = FSYNC_INTERVAL):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        segments = _segments(directory)
+        self.segment = segments[-1] if segments else 0
+        self.since_snapshot = 0  # entries appended since the last snapshot
+        self.snapshot_at = time.monotonic()
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, room_id: str, kind: str, args: tuple):
+        self._queue.put(codec.dumps([room_id, kind, *args]))
+        self.since_snapshot += 1
+
+    def snapshot(self, rooms: Dict[str, dict]):
+        """
+        @param rooms: room ID -> MafiaGame.to_snapshot(), taken between two inputs
+
+        Everything appended before this call stays in the current segment; the
+        snapshot covers it, so older segments are deleted once it's on disk.
+        """
+        self.segment += 1
+        self._queue.put({"segment": self.segment, "rooms": rooms})
+        self.since_snapshot = 0
+        self.snapshot_at = time.monotonic()
+
+    def snapshot_due(self) -> bool:
+        if self.since_snapshot >= MAX_TAIL:
+            return True
+        return self.since_snapshot > 0 and time.monotonic() - self.snapshot_at >= SNAPSHOT_INTERVAL
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def load(self) -> Tuple[Dict[str, dict], Iterator[Tuple[str, str, list]]]:
+        """Returns the latest snapshot's rooms and the journal entries written after it"""
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        rooms, first_segment = {}, 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                snapshot = codec.loads(f.read())
+            rooms, first_segment = snapshot["rooms"], snapshot["segment"]
+        segments = [segment for segment in _segments(self.directory) if segment >= first_segment]
+        return rooms, self._entries(segments)
+
+    def _entries(self, segments: List[int]) -> Iterator[Tuple[str, str, list]]:
+        for segment in segments:
+            with open(_segment_path(self.directory, segment), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        room_id, kind, *args = codec.loads(line)
+                    except (*codec.errors, ValueError):
+                        # Only the last line of a crash can be torn; nothing after it was acknowledged
+                        log.warning("Skipping unreadable journal line in segment %d: %r", segment, line)
+                        continue
+                    yield room_id, kind, args
+
+    # ---- writer thread ----
+
+    def _run(self):
+        out = open(_segment_path(self.directory, self.segment), "a", encoding="utf-8")
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            if self.fsync_interval > 0:
+                time.sleep(self.fsync_interval)
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, str):
+                    lines.append(item)
+                else:
+                    self._write(out, lines)
+                    lines = []
+                    out.close()
+                    self._write_snapshot(item)
+                    out = open(_segment_path(self.directory, item["segment"]), "a", encoding="utf-8")
+            self._write(out, lines)
+        out.close()
+
+    def _write(self, out, lines: List[str]):
+        if not lines:
+            return
+        out.write("\n".join(lines) + "\n")
+        out.flush()
+        os.fsync(out.fileno())
+
+    def _write_snapshot(self, snapshot: dict):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(codec.dumps(snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        _fsync_dir(self.directory)
+        for segment in _segments(self.directory):
+            if segment < snapshot["segment"]:
+                os.remove(_segment_path(self.directory, segment))
@@ -0,0 +1,266 @@
+"""
+Load generator for server.py: simulates many rooms of bot players in one process
+(or several with --processes) and plays full games against a running server.
+
+    python loadtest.py --rooms 20 --players 7 --games 3
+
+Every simulated player opens a browser connection and an rpi connection, like a
+real seat. Latency for an action is the time from sending it until the next
+frame the server sends back to that player, so it measures how quickly the
+table reacts rather than a strict request/response round trip.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import websockets
+
+from protocol import BINARY, encode_binary, decode_binary
+
+SERVER_URI = "ws://127.0.0.1:5050"
+REPLY_TIMEOUT = 5.0  # latencies longer than this count as unanswered
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)  # action -> seconds
+        self.unanswered: Dict[str, int] = defaultdict(int)
+        self.sent = 0
+        self.received = 0
+        self.games = 0
+        self.stuck_rooms = 0
+        self.errors: List[str] = []
+
+    def merge(self, other: "Stats"):
+        for action, values in other.latencies.items():
+            self.latencies[action].extend(values)
+        for action, count in other.unanswered.items():
+            self.unanswered[action] += count
+        self.sent += other.sent
+        self.received += other.received
+        self.games += other.games
+        self.stuck_rooms += other.stuck_rooms
+        self.errors.extend(other.errors)
+
+
+class Connection:
+    """One websocket of a simulated player that times sent actions against the next reply"""
+    def __init__(self, ws, stats: Stats):
+        self.ws = ws
+        self.stats = stats
+        self.pending: List[tuple] = []  # (action, sent_at) waiting for the next frame
+
+    async def send(self, action: str, frame):
+        self.pending.append((action, time.perf_counter()))
+        self.stats.sent += 1
+        await self.ws.send(frame)
+
+    async def send_json(self, action: str, **fields):
+        await self.send(action, json.dumps({"action": action, **fields}))
+
+    def received(self):
+        now = time.perf_counter()
+        self.stats.received += 1
+        for action, sent_at in self.pending:
+            elapsed = now - sent_at
+            if elapsed <= REPLY_TIMEOUT:
+                self.stats.latencies[action].append(elapsed)
+            else:
+                self.stats.unanswered[action] += 1
+        self.pending.clear()
+
+    def finish(self):
+        for action, _ in self.pending:
+            self.stats.unanswered[action] += 1
+        self.pending.clear()
+
+
+class SimPlayer:
+    def __init__(self, room: str, index: int, players: int, games: int, stats: Stats,
+                 uri: str, binary: bool, think: float, deltas: bool = False):
+        self.room = room
+        self.index = index
+        self.name = f"{room}-p{index}"
+        self.players = players
+        self.games = games
+        self.stats = stats
+        self.uri = uri
+        self.binary = binary
+        self.think = think
+        self.deltas = deltas
+        self.player_id = 0
+        self.binary_confirmed = False
+
+    async def run(self, registered: asyncio.Barrier):
+        async with websockets.connect(self.uri) as browser_ws, websockets.connect(self.uri) as rpi_ws:
+            browser = Connection(browser_ws, self.stats)
+            rpi = Connection(rpi_ws, self.stats)
+            if self.deltas:
+                await browser.send_json("setup", target=self.name, room=self.room, deltas=True)
+            else:
+                await browser.send_json("setup", target=self.name, room=self.room)
+            # Like a real table: the pi links to a player the browser already registered
+            # (with several workers the two setups could otherwise overtake each other)
+            await self.wait_for(browser, "id_registered")
+            setup = {"name": self.name, "target": "rpi", "room": self.room}
+            if self.binary:
+                setup["protocol"] = BINARY
+            await rpi.send_json("setup", **setup)
+
+            rpi_task = asyncio.create_task(self.rpi_loop(rpi))
+            try:
+                await registered.wait()
+                await browser.send_json("ready", target=None)
+                await self.browser_loop(browser)
+            finally:
+                rpi_task.cancel()
+                browser.finish()
+                rpi.finish()
+
+    async def wait_for(self, conn: Connection, action: str):
+        async for raw in conn.ws:
+            conn.received()
+            if json.loads(raw).get("action") == action:
+                return
+
+    async def browser_loop(self, browser: Connection):
+        leader = self.index == 1
+        games = 0
+        lobby: Dict[str, bool] = {}  # name -> ready, rebuilt from lobby_status and lobby_delta
+        seq = 0
+        async for raw in browser.ws:
+            browser.received()
+            msg = json.loads(raw)
+            action = msg.get("action")
+            target = msg.get("target")
+            if action == "lobby_status":
+                lobby, seq = dict(target["players"]), target["seq"]
+            elif action == "lobby_delta":
+                if target["seq"] != seq + 1:
+                    await browser.send_json("resync", target=None)
+                    continue
+                seq = target["seq"]
+                if "leave" in target:
+                    lobby.pop(target["leave"], None)
+                else:
+                    name = target.get("join") or target.get("ready")
+                    lobby[name] = lobby.get(name, False) or "ready" in target
+            if action in ("lobby_status", "lobby_delta") and leader and len(lobby) == self.players \
+                    and all(lobby.values()):
+                await self.pause()
+                await browser.send_json("voiceCommand", target=2)
+            elif action == "heads_down":
+                await self.pause()
+                await browser.send_json("headDown", target=None)
+            elif action == "night_result" and leader:
+                await self.pause()
+                await browser.send_json("voiceCommand", target=3)
+            elif action == "game_over":
+                games += 1
+                if leader:
+                    self.stats.games += 1
+                if games >= self.games:
+                    return
+                await self.pause()
+                await browser.send_json("restart", target=None)
+
+    async def rpi_loop(self, rpi: Connection):
+        async for raw in rpi.ws:
+            rpi.received()
+            if isinstance(raw, bytes):
+                decoded = decode_binary(raw)
+                action = decoded.action if decoded else None
+            else:
+                msg = json.loads(raw)
+                action = msg.get("action")
+                if action == "id_registered":
+                    self.player_id = msg.get("player")
+                    self.binary_confirmed = (msg.get("target") or {}).get("protocol") == BINARY
+            if action in ("kill", "save", "vote"):
+                await self.pause()
+                target = random.randint(1, self.players)
+                frame = encode_binary("targeted", self.player_id, target) if self.binary_confirmed else None
+                if frame is None:
+                    frame = json.dumps({"action": "targeted", "name": self.name, "target": str(target)})
+                await rpi.send(f"targeted:{action}", frame)
+
+    async def pause(self):
+        if self.think:
+            await asyncio.sleep(random.uniform(0, self.think))
+
+
+async def run_room(room: str, args, stats: Stats):
+    registered = asyncio.Barrier(args.players)
+    players = [SimPlayer(room, i, args.players, args.games, stats, args.uri, args.binary, args.think, args.deltas)
+               for i in range(1, args.players + 1)]
+    try:
+        await asyncio.wait_for(asyncio.gather(*(p.run(registered) for p in players)), args.timeout)
+    except asyncio.TimeoutError:
+        stats.stuck_rooms += 1
+    except (OSError, websockets.exceptions.WebSocketException) as e:
+        stats.errors.append(f"{room}: {e!r}")
+
+
+async def run_rooms(rooms: List[str], args) -> Stats:
+    stats = Stats()
+    await asyncio.gather(*(run_room(room, args, stats) for room in rooms))
+    return stats
+
+
+def run_worker(rooms: List[str], args) -> Stats:
+    return asyncio.run(run_rooms(rooms, args))
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def report(stats: Stats, elapsed: float):
+    print(f"\n{stats.games} games in {elapsed:.1f}s, {stats.stuck_rooms} stuck rooms, {len(stats.errors)} errors")
+    print(f"sent {stats.sent} ({stats.sent / elapsed:.0f}/s), received {stats.received} ({stats.received / elapsed:.0f}/s)")
+    print(f"\n{'action':<18}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'unanswered':>12}")
+    for action in sorted(set(stats.latencies) | set(stats.unanswered)):
+        values = stats.latencies.get(action, [])
+        if values:
+            p50, p95, p99 = (percentile(values, p) * 1000 for p in (50, 95, 99))
+            print(f"{action:<18}{len(values):>8}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}{stats.unanswered[action]:>12}")
+        else:
+            print(f"{action:<18}{0:>8}{'-':>10}{'-':>10}{'-':>10}{stats.unanswered[action]:>12}")
+    for error in stats.errors[:10]:
+        print("error:", error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many players against server.py")
+    parser.add_argument("--uri", default=SERVER_URI)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--players", type=int, default=7, help="players per room")
+    parser.add_argument("--games", type=int, default=2, help="games each room plays before leaving")
+    parser.add_argument("--processes", type=int, default=1, help="split rooms over this many processes")
+    parser.add_argument("--think", type=float, default=0.0, help="max random delay in seconds before each bot action")
+    parser.add_argument("--binary", action="store_true", help="rpis use the binary protocol")
+    parser.add_argument("--deltas", action="store_true", help="browsers ask for lobby/restart status as deltas")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds before a room counts as stuck")
+    args = parser.parse_args()
+
+    rooms = [f"load-{i}" for i in range(args.rooms)]
+    started = time.perf_counter()
+    if args.processes <= 1:
+        stats = run_worker(rooms, args)
+    else:
+        chunks = [rooms[i::args.processes] for i in range(args.processes)]
+        stats = Stats()
+        with multiprocessing.Pool(args.processes) as pool:
+            for part in pool.starmap(run_worker, [(chunk, args) for chunk in chunks if chunk]):
+                stats.merge(part)
+    report(stats, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+# MAFIA_LOG_LEVEL=DEBUG adds the per-message output without code changes
+LOG_LEVEL = os.environ.get("MAFIA_LOG_LEVEL", "INFO").upper()
+# "text" for the console, "json" for one structured object per line
+LOG_FORMAT = os.environ.get("MAFIA_LOG_FORMAT", "text").lower()
+# Also send debug steps to players as "status" messages (handy when watching the UI)
+DEBUG_STATUS = os.environ.get("MAFIA_DEBUG_STATUS", "0") == "1"
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+class _ContextFilter(logging.Filter):
+    """Makes sure every record has the context fields the formatters use"""
+    def filter(self, record):
+        if not hasattr(record, "room"):
+            record.room = "-"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "room": record.room,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """
+    @param level: minimum level that gets written
+    @param fmt: "text" or "json"
+
+    Routes every "mafia" logger through a queue. The event loop only enqueues
+    records; a QueueListener thread does the formatting and console I/O.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler()
+    if fmt == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)-5s [%(room)s] %(name)s: %(message)s"))
+
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger("mafia")
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(records, stream)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def get_logger(name: str, room: str | None = None) -> logging.LoggerAdapter:
+    """
+    @param name: component name, e.g. "server" or "game"
+    @param room: room ID added to every record from this logger
+
+    Pass arguments lazily (log.debug("x=%s", x)) so disabled levels cost nothing.
+    """
+    return logging.LoggerAdapter(logging.getLogger(f"mafia.{name}"), {"room": room or "-"})
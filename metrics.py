@@ -0,0 +1,208 @@
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+from log import get_logger
+
+# Local HTTP endpoint for Prometheus to scrape; MAFIA_METRICS_PORT=0 turns it off
+METRICS_HOST = os.environ.get("MAFIA_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("MAFIA_METRICS_PORT", "9105"))
+
+# Seconds; fine at the low end since most handlers finish well under a millisecond
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+log = get_logger("metrics")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += self.samples()
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}  # label values -> total
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        values = self.values or ({} if self.labels else {(): 0})
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in values.items()]
+
+
+class Gauge(Metric):
+    """A value read when the endpoint is scraped, so nothing has to keep it up to date"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        super().__init__(name, help)
+        self.read = read
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {_format_value(self.read())}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self.series: Dict[Tuple[str, ...], list] = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *labels: str):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        # Count only the first bucket that fits; render() makes them cumulative
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, help, labels))
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, help, read))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+MESSAGES = REGISTRY.counter("mafia_messages_total", "Inbound messages by action", ("action",))
+HANDLER_SECONDS = REGISTRY.histogram("mafia_handler_seconds", "Time to handle one inbound message", ("action",))
+THROTTLED = REGISTRY.counter("mafia_throttled_messages_total", "Inbound messages dropped by rate limits or shed under load", ("action", "reason"))
+REJECTED = REGISTRY.counter("mafia_rejected_messages_total", "Inbound messages dropped as not valid in the room's state", ("action",))
+UPDATE_SECONDS = REGISTRY.histogram("mafia_update_seconds", "Duration of MafiaGame.update() by triggering event", ("event",))
+LOCK_WAIT_SECONDS = REGISTRY.histogram("mafia_lock_wait_seconds", "Time spent waiting to acquire a room lock")
+LOCK_HOLD_SECONDS = REGISTRY.histogram("mafia_lock_hold_seconds", "Time a room lock was held")
+STATE_SECONDS = REGISTRY.counter("mafia_state_seconds_total", "Seconds rooms spent in each state before leaving it", ("state",))
+FRAMES_DROPPED = REGISTRY.counter("mafia_outbound_dropped_total", "Outbound frames shed by full outboxes")
+EVICTIONS = REGISTRY.counter("mafia_evictions_total", "Connections closed for falling behind", ("reason",))
+RELOADS = REGISTRY.counter("mafia_reloads_total", "Hot reloads of the game logic", ("result",))
+DEADLINES = REGISTRY.counter("mafia_phase_deadlines_total", "Phases resolved by their deadline instead of the players", ("state",))
+
+
+class TimedLock:
+    """asyncio.Lock that records how long callers wait for it and how long they hold it"""
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._acquired_at = 0.0
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        await self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        LOCK_WAIT_SECONDS.observe(self._acquired_at - started)
+
+    async def __aexit__(self, *exc):
+        LOCK_HOLD_SECONDS.observe(time.perf_counter() - self._acquired_at)
+        self._lock.release()
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        # Drain the headers; nothing in them matters here
+        while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", REGISTRY.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> asyncio.AbstractServer | None:
+    """
+    @param host: interface to listen on (local only by default)
+    @param port: 0 disables the endpoint
+
+    Serves GET /metrics in Prometheus text format from the running event loop
+    """
+    if not port:
+        return None
+    server = await asyncio.start_server(_serve, host, port)
+    log.info("Metrics on http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,104 @@
+import asyncio
+import os
+from collections import deque
+from typing import Union
+
+from websockets.exceptions import ConnectionClosed
+from websockets.legacy.server import WebSocketServerProtocol
+
+from log import get_logger
+from metrics import EVICTIONS, FRAMES_DROPPED
+from util import SEND_TIMEOUT, drop_connection, spawn
+
+# Frames a connection may have waiting before the overflow policy kicks in
+OUTBOX_SIZE = int(os.environ.get("MAFIA_OUTBOX_SIZE", "64"))
+# "shed": drop status chatter first, disconnect only when nothing is droppable
+# "disconnect": disconnect as soon as the queue is full
+OVERFLOW_POLICIES = ("shed", "disconnect")
+OVERFLOW_POLICY = os.environ.get("MAFIA_OUTBOX_OVERFLOW", "shed").strip().lower()
+if OVERFLOW_POLICY not in OVERFLOW_POLICIES:
+    raise ValueError(f"MAFIA_OUTBOX_OVERFLOW must be one of {', '.join(OVERFLOW_POLICIES)}, not {OVERFLOW_POLICY!r}")
+
+log = get_logger("outbound")
+
+
+class Outbox:
+    """
+    Bounded send queue for one connection, drained by its own writer task.
+    Game logic calls put() and returns immediately; only the writer waits on
+    the network, with SEND_TIMEOUT per frame before the client is evicted.
+    """
+    def __init__(self, ws: WebSocketServerProtocol, maxsize: int = OUTBOX_SIZE,
+                 policy: str = OVERFLOW_POLICY, send_timeout: float = SEND_TIMEOUT):
+        self.ws = ws
+        self.maxsize = maxsize
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.frames: deque = deque()  # (frame, droppable)
+        self.dropped = 0
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._writer = spawn(self._write_loop())
+
+    def put(self, frame: Union[str, bytes], droppable: bool = False) -> bool:
+        """
+        @param frame: encoded frame
+        @param droppable: status chatter that may be shed under pressure
+
+        Returns False if the frame was not queued
+        """
+        if self.closed:
+            return False
+        if len(self.frames) >= self.maxsize and not self._make_room(droppable):
+            return False
+        self.frames.append((frame, droppable))
+        self._wakeup.set()
+        return True
+
+    def _make_room(self, droppable: bool) -> bool:
+        if self.policy == "shed":
+            if droppable:
+                self.dropped += 1
+                FRAMES_DROPPED.inc()
+                return False
+            for i, (_, queued_droppable) in enumerate(self.frames):
+                if queued_droppable:
+                    del self.frames[i]
+                    self.dropped += 1
+                    FRAMES_DROPPED.inc()
+                    return True
+        self.evict("Outbound queue full")
+        return False
+
+    def evict(self, reason: str):
+        """Stop sending and close the connection; the handler's cleanup removes the player"""
+        if self.closed:
+            return
+        log.warning("Evicting slow client %s: %s (%d frames pending, %d dropped)",
+                    self.ws.remote_address, reason, len(self.frames), self.dropped)
+        EVICTIONS.inc(reason)
+        self.close()
+        drop_connection(self.ws, reason)
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        # Wake the writer so it sees closed even if the cancel below is lost
+        self._wakeup.set()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+    async def _write_loop(self):
+        try:
+            while not self.closed:
+                while not self.frames and not self.closed:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                if self.closed:
+                    return
+                frame, _ = self.frames.popleft()
+                await asyncio.wait_for(self.ws.send(frame), self.send_timeout)
+        except asyncio.TimeoutError:
+            self.evict("Client too slow")
+        except (ConnectionClosed, OSError):
+            self.close()
@@ -0,0 +1,46 @@
+from dataclasses import dataclass
+from enum import Enum
+
+
+class Head(str, Enum):
+    UP = "up"
+    DOWN = "down"
+
+
+class Role(str, Enum):
+    CIVILIAN = "civilian"
+    MAFIA = "mafia"
+    DOCTOR = "doctor"
+
+
+@dataclass(slots=True)
+class Player:
+    """
+    One seat at the table. Fields that feed MafiaGame's running counters
+    (ready, restart, head, vote, alive) must be changed through the game's setters.
+    """
+    name: str
+    player_id: int
+    setup: bool = True
+    ready: bool = False
+    restart: bool = False
+    voice_command: bool = False
+    head: Head = Head.UP
+    vote: str | None = None
+    kill: str | None = None
+    save: str | None = None
+    alive: bool = True
+    role: Role = Role.CIVILIAN
+    token: str = ""  # resume token handed out with id_registered
+
+    def reset_for_new_round(self):
+        """Back to a fresh, ready seat for the next game"""
+        self.ready = True
+        self.restart = False
+        self.voice_command = False
+        self.head = Head.UP
+        self.vote = None
+        self.kill = None
+        self.save = None
+        self.alive = True
+        self.role = Role.CIVILIAN
@@ -0,0 +1,84 @@
+import struct
+from typing import NamedTuple, Optional, Union
+
+# Imported by the Pi client too, so this module stays stdlib-only and 3.7-compatible
+
+# Wire protocols a connection can negotiate in its setup message ("protocol" field)
+JSON = "json"
+BINARY = "binary"
+
+# Binary frame: action code, player ID, target player ID (0 = none), then an
+# optional UTF-8 tail for targets that aren't player IDs. Three bytes cover
+# everything a Pi sends or receives during a game.
+HEADER = struct.Struct("!BBB")
+
+ACTION_CODES = {
+    "setup": 1,
+    "id_registered": 2,
+    "civilian": 3,
+    "mafia": 4,
+    "doctor": 5,
+    "kill": 6,
+    "save": 7,
+    "vote": 8,
+    "targeted": 9,
+    "headUp": 10,
+    "headDown": 11,
+    "ready": 12,
+    "restart": 13,
+    "voiceCommand": 14,
+    "heads_down": 15,
+    "status": 16,
+}
+ACTIONS = {code: action for action, code in ACTION_CODES.items()}
+
+
+class Frame(NamedTuple):
+    """One decoded binary frame"""
+    action: str
+    player_id: int
+    target: Union[str, int, None]
+
+
+def encode_binary(action: str, player_id: int, target: Union[str, int, None] = None) -> Optional[bytes]:
+    """
+    @param action: message action
+    @param player_id: recipient/sender player ID (0-255)
+    @param target: a player ID, free-form text, or None
+
+    Returns None when the message has no binary form; send it as JSON instead
+    """
+    code = ACTION_CODES.get(action)
+    if code is None or not isinstance(player_id, int) or not 0 <= player_id <= 255:
+        return None
+    if target is None:
+        return HEADER.pack(code, player_id, 0)
+    if isinstance(target, int) and not isinstance(target, bool) and 0 < target <= 255:
+        return HEADER.pack(code, player_id, target)
+    if isinstance(target, str):
+        return HEADER.pack(code, player_id, 0) + target.encode()
+    return None
+
+
+def decode_binary(data: bytes) -> Optional[Frame]:
+    """
+    @param data: raw binary frame
+
+    Returns the decoded Frame, or None for a malformed frame
+    """
+    if len(data) < HEADER.size:
+        return None
+    code, player_id, target_id = HEADER.unpack_from(data)
+    action = ACTIONS.get(code)
+    if action is None:
+        return None
+    if target_id:
+        target = target_id
+    elif len(data) > HEADER.size:
+        try:
+            target = data[HEADER.size:].decode()
+        except UnicodeDecodeError:
+            return None
+    else:
+        target = None
+    return Frame(action, player_id, target)
@@ -8,11 +8,25 @@ import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'berryIMU'))
 from gesturetwo import BerryIMUInterface, GestureRecognizer
+from protocol import BINARY, encode_binary, decode_binary
 
 SERVER_IP = "127.0.0.1"  # Change this to your cloud server's IP address
 SERVER_PORT = 5050
+USE_BINARY_PROTOCOL = True  # 3-byte frames once the server confirms it, JSON otherwise
+RECONNECT_DELAY = 2  # seconds between reconnect attempts once we have a seat to resume
+
+# Filled in from the server's id_registered (or resumed) message
+session = {"player_id": 0, "binary": False, "token": None}
 
 def parse_json(message: Data):
+    if isinstance(message, bytes):
+        decoded = decode_binary(message)
+        if decoded is None:
+            print("Invalid binary frame:", message)
+            return None
+        parsed = {"player": decoded.player_id, "action": decoded.action, "target": decoded.target}
+        print(parsed)
+        return parsed
     try:
         parsed = json.loads(message)
         print(parsed)
@@ -22,6 +36,11 @@ def parse_json(message: Data):
         return None
 
 async def send_signal_to_server(ws, action, target, name):
+    if session["binary"]:
+        frame = encode_binary(action, session["player_id"], int(target) if str(target).isnumeric() else target)
+        if frame is not None:
+            await ws.send(frame)
+            return
     msg = {
         "action": action,
         "name": name,
@@ -105,6 +124,13 @@ async def rpi_helper(ws, name, imu, recognizer):
             if not msg:
                 continue
             action = msg.get("action")
+            if action in ("id_registered", "resumed"):
+                registered = msg.get("target") or {}
+                session["player_id"] = msg.get("player")
+                session["binary"] = registered.get("protocol") == BINARY
+                session["token"] = registered.get("token")
+                print(f"[DEBUG] {'resumed' if action == 'resumed' else 'registered'} as player {session['player_id']} ({'binary' if session['binary'] else 'json'})")
+                continue
             if action in ["civilian", "mafia", "doctor"]:
                 role = action
                 print(f"[DEBUG] received role: {action}")
@@ -132,7 +158,16 @@ async def rpi_helper(ws, name, imu, recognizer):
     finally:
         print("[DEBUG] Player leaving...")
 
-async def rpi_handler(name):
+async def rpi_handler(name, room="default"):
+    """Keeps reconnecting after a drop so the server can give us back our seat"""
+    while True:
+        await rpi_session(name, room)
+        if not session["token"]:
+            return
+        print(f"[DEBUG] Connection lost, trying to resume in {RECONNECT_DELAY}s...")
+        await asyncio.sleep(RECONNECT_DELAY)
+
+async def rpi_session(name, room):
     uri = f"ws://{SERVER_IP}:{SERVER_PORT}"
 
     print(f"[DEBUG] Connecting to {uri}")
@@ -150,10 +185,15 @@ async def rpi_handler(name):
             setup_msg = {
                 "action": "setup",
                 "name": name,
-                "target": "rpi"
+                "target": "rpi",
+                "room": room
             }
+            if USE_BINARY_PROTOCOL:
+                setup_msg["protocol"] = BINARY
+            if session["token"]:
+                setup_msg["resume"] = session["token"]
             await ws.send(json.dumps(setup_msg))
-            print(f"[DEBUG] Sent setup message with name: {name}")
+            print(f"[DEBUG] Sent setup message with name: {name}, room: {room}")
             
             imu = BerryIMUInterface(debug=False)
             recognizer = GestureRecognizer()
@@ -186,5 +226,6 @@ async def rpi_handler(name):
 if __name__ == "__main__":
     # Get player name from command line argument
     player_name = sys.argv[1] if len(sys.argv) > 1 else "RaspberryPiPlayer"
-    print(f"[DEBUG] Starting with player name: {player_name}")
-    asyncio.run(rpi_handler(player_name))
+    room = sys.argv[2] if len(sys.argv) > 2 else "default"
+    print(f"[DEBUG] Starting with player name: {player_name}, room: {room}")
+    asyncio.run(rpi_handler(player_name, room))
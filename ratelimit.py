@@ -0,0 +1,106 @@
+import asyncio
+import os
+import time
+from typing import Dict, Tuple
+
+from log import get_logger
+
+# Key for the limit on all of a connection's frames together
+ALL = "*"
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """
+    @param spec: e.g. "*=50/100,headUp=20/20", action=rate/burst; "" or "off" for no limits
+    """
+    limits = {}
+    if spec.strip().lower() == "off":
+        return limits
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        action, _, limit = item.partition("=")
+        rate, _, burst = limit.partition("/")
+        limits[action.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+# Frames per second each connection may send of an action on average, and how many
+# back to back (rate/burst). "*" covers every frame of the connection, known or not.
+# Off unless set; the README lists limits that suit a normal table.
+RATE_LIMITS = parse_limits(os.environ.get("MAFIA_RATE_LIMITS", ""))
+# Seconds the event loop may fall behind before low-priority messages are shed.
+# Off (0) unless set, like rate limiting.
+SHED_LAG = float(os.environ.get("MAFIA_SHED_LAG", "0"))
+# Seconds between loop lag samples
+LAG_INTERVAL = 0.1
+
+log = get_logger("ratelimit")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst  # a new connection may burst right away
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+
+class RateLimiter:
+    """
+    Token buckets of one connection: one per limited action plus the "*" bucket
+    shared by all of its frames. A frame goes through only if every bucket it
+    draws from has a token, and then takes one from each.
+    """
+    __slots__ = ("chains", "default", "dropped")
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]] = RATE_LIMITS):
+        shared = (TokenBucket(*limits[ALL]),) if ALL in limits else ()
+        self.chains = {action: (TokenBucket(*limit), *shared)
+                       for action, limit in limits.items() if action != ALL}
+        self.default = shared
+        self.dropped = 0
+
+    def allow(self, action: str) -> bool:
+        chain = self.chains.get(action, self.default)
+        now = time.monotonic()
+        for bucket in chain:
+            bucket.refill(now)
+            if bucket.tokens < 1:
+                self.dropped += 1
+                return False
+        for bucket in chain:
+            bucket.tokens -= 1
+        return True
+
+
+class LagMonitor:
+    """
+    Samples how late the event loop wakes a sleeping task. While that lag is past
+    the threshold the server is overloaded and sheds messages it can do without.
+    """
+    def __init__(self, threshold: float = SHED_LAG, interval: float = LAG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.lag = 0.0
+
+    @property
+    def overloaded(self) -> bool:
+        return 0 < self.threshold < self.lag
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            was_overloaded = self.overloaded
+            self.lag = max(0.0, loop.time() - started - self.interval)
+            if self.overloaded != was_overloaded:
+                if self.overloaded:
+                    log.warning("Event loop is %.0fms behind, shedding low-priority messages", self.lag * 1000)
+                else:
+                    log.info("Event loop caught up, no longer shedding")
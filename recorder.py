@@ -0,0 +1,143 @@
+import atexit
+import base64
+import os
+import queue
+import re
+import threading
+import time
+from typing import Dict, List, TextIO, Union
+
+from codec import codec
+from log import get_logger
+
+# Directory for per-room session recordings; empty turns recording off
+RECORD_DIR = os.environ.get("MAFIA_RECORD_DIR", "")
+
+# Resume tokens are random on every run, so comparisons ignore them
+_TOKEN = re.compile(r'"token":"[^"]*"')
+
+log = get_logger("recorder")
+
+
+def encode_frame_data(frame: Union[str, bytes]):
+    return {"b": base64.b64encode(frame).decode()} if isinstance(frame, bytes) else frame
+
+
+def decode_frame_data(data) -> Union[str, bytes]:
+    return base64.b64decode(data["b"]) if isinstance(data, dict) else data
+
+
+def mask_tokens(frame: Union[str, bytes]) -> Union[str, bytes]:
+    return _TOKEN.sub('"token":"*"', frame) if isinstance(frame, str) else frame
+
+
+class _Writer:
+    """
+    One thread that writes every room's recording, so file I/O stays off the
+    event loop. Items are (file, text), or (file, None) to close the file; they
+    are handled in order, so a close comes after everything written before it.
+    """
+    def __init__(self):
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+
+    def put(self, out: TextIO, text: str | None):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="recording-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+        self._queue.put((out, text))
+
+    def stop(self):
+        """Write out what's queued and stop the thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while (item := self._queue.get()) is not None:
+            out, text = item
+            try:
+                if text is None:
+                    out.close()
+                else:
+                    out.write(text)
+            except (OSError, ValueError):
+                log.exception("Can't write recording %s", getattr(out, "name", out))
+
+
+_writer = _Writer()
+
+
+class Recording:
+    """
+    Timestamped traffic of one room, one JSON array per line after a header:
+    [seconds, conn, "in", frame], [seconds, conn, "out", frame], [seconds, conn, "close"],
+    [seconds, 0, "deadline", [state, transition_count]] when a phase times out,
+    and [seconds, 0, "window", name] when a player's head debounce window ends.
+    Connections are numbered in the order they first show up in the room.
+    """
+    def __init__(self, header: dict, out: TextIO | None = None):
+        self.header = header
+        self.out = out
+        self.lines: List[list] = []  # kept in memory when there is no file
+        self.stopped = False  # close() was called; later traffic isn't kept
+        self.started = time.monotonic()
+        self.conn_ids: Dict[object, int] = {}  # ws -> connection number
+        if out is not None:
+            _writer.put(out, codec.dumps(header) + "\n")
+
+    @classmethod
+    def open(cls, room_id: str, seed: int, debounce: float, directory: str = RECORD_DIR) -> "Recording":
+        os.makedirs(directory, exist_ok=True)
+        safe_room = re.sub(r"[^A-Za-z0-9_.-]", "_", room_id)
+        path = os.path.join(directory, f"{safe_room}-{time.strftime('%Y%m%d-%H%M%S')}-{seed % 10000:04d}.jsonl")
+        log.info("Recording room %s to %s", room_id, path)
+        header = {"room": room_id, "seed": seed, "debounce": debounce, "started": time.time()}
+        return cls(header, open(path, "w", encoding="utf-8", buffering=1 << 16))
+
+    def conn(self, ws) -> int:
+        conn_id = self.conn_ids.get(ws)
+        if conn_id is None:
+            conn_id = self.conn_ids[ws] = len(self.conn_ids) + 1
+        return conn_id
+
+    def _write(self, entry: list):
+        if self.stopped:
+            return
+        if self.out is None:
+            self.lines.append(entry)
+        else:
+            _writer.put(self.out, codec.dumps(entry) + "\n")
+
+    def inbound(self, ws, frame: Union[str, bytes]):
+        self._write([round(time.monotonic() - self.started, 6), self.conn(ws), "in", encode_frame_data(frame)])
+
+    def outbound(self, ws, frame: Union[str, bytes]):
+        self._write([round(time.monotonic() - self.started, 6), self.conn(ws), "out", encode_frame_data(frame)])
+
+    def deadline(self, state: str, transition_count: int):
+        self._write([round(time.monotonic() - self.started, 6), 0, "deadline", [state, transition_count]])
+
+    def window_end(self, name: str):
+        self._write([round(time.monotonic() - self.started, 6), 0, "window", name])
+
+    def closed(self, ws):
+        if ws in self.conn_ids:
+            self._write([round(time.monotonic() - self.started, 6), self.conn_ids[ws], "close"])
+
+    def close(self):
+        """Stops recording; the file is closed once the writer thread gets to it"""
+        self.stopped = True
+        if self.out is not None:
+            _writer.put(self.out, None)
+            self.out = None
+
+
+def load_recording(path: str):
+    """Returns (header, entries) of a recording file"""
+    with open(path, encoding="utf-8") as f:
+        header = codec.loads(f.readline())
+        entries = [codec.loads(line) for line in f if line.strip()]
+    return header, entries
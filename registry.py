@@ -0,0 +1,111 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List
+
+from websockets.legacy.server import WebSocketServerProtocol
+
+from outbound import Outbox
+from player import Role
+
+# Device types a player can connect with
+BROWSER = "browser"
+RPI = "rpi"
+
+
+@dataclass(slots=True, eq=False)
+class Connection:
+    """One websocket of a room, from setup until it closes"""
+    ws: WebSocketServerProtocol
+    outbox: Outbox
+    name: str | None = None  # seated player; None until registered
+    device: str | None = None  # BROWSER or RPI once registered
+    role: Role = Role.CIVILIAN
+    binary: bool = False  # rpi negotiated the binary protocol
+    deltas: bool = False  # browser asked for lobby/restart deltas
+    synced: str | None = None  # status action ("lobby_status"/"restart_status") a delta browser holds current
+
+
+class ConnectionRegistry:
+    """
+    Every connection of one room, indexed by websocket, by player and device,
+    by device and by role, so lookups like "this player's rpi" or "all mafia
+    rpis" and removing a closed connection are dict operations. Each index
+    keeps insertion order, so sends go out in the order players registered.
+    """
+    def __init__(self):
+        self.by_ws: Dict[WebSocketServerProtocol, Connection] = {}
+        self.by_player: Dict[tuple, Connection] = {}  # (name, device) -> connection
+        self.by_device: Dict[str, Dict[WebSocketServerProtocol, Connection]] = {BROWSER: {}, RPI: {}}
+        self.by_role: Dict[tuple, Dict[WebSocketServerProtocol, Connection]] = {
+            (role, device): {} for role in Role for device in (BROWSER, RPI)}
+
+    def __iter__(self) -> Iterator[Connection]:
+        return iter(self.by_ws.values())
+
+    def open(self, ws: WebSocketServerProtocol, outbox: Outbox) -> Connection:
+        """Track a new connection that hasn't registered a player yet"""
+        conn = self.by_ws[ws] = Connection(ws, outbox)
+        return conn
+
+    def get(self, ws: WebSocketServerProtocol) -> Connection | None:
+        return self.by_ws.get(ws)
+
+    def of(self, name: str, device: str) -> Connection | None:
+        return self.by_player.get((name, device))
+
+    def devices(self, device: str) -> Iterator[Connection]:
+        """All registered connections of one device type"""
+        return iter(self.by_device[device].values())
+
+    def with_role(self, role: Role, device: str) -> Iterator[Connection]:
+        return iter(self.by_role[(role, device)].values())
+
+    def count(self, device: str) -> int:
+        return len(self.by_device[device])
+
+    def attach(self, ws: WebSocketServerProtocol, name: str, device: str, role: Role) -> Connection | None:
+        """
+        Register an open connection as this player's browser or rpi. Returns the
+        connection it replaces (still open, e.g. after a resume), if any.
+        """
+        conn = self.by_ws[ws]
+        old = self.by_player.get((name, device))
+        if old is conn and conn.role == role:
+            return None
+        # Drop whatever this connection was registered as before, e.g. another name
+        self._unindex(conn)
+        if old is conn:
+            old = None
+        elif old is not None:
+            self._unindex(old)
+        conn.name, conn.device, conn.role = name, device, role
+        self.by_player[(name, device)] = conn
+        self.by_device[device][ws] = conn
+        self.by_role[(role, device)][ws] = conn
+        return old
+
+    def set_roles(self, role_of: Callable[[str], Role]):
+        """Re-index every registered connection after roles were dealt or reset"""
+        for index in self.by_role.values():
+            index.clear()
+        for device, conns in self.by_device.items():
+            for ws, conn in conns.items():
+                conn.role = role_of(conn.name)
+                self.by_role[(conn.role, device)][ws] = conn
+
+    def remove(self, ws: WebSocketServerProtocol) -> Connection | None:
+        conn = self.by_ws.pop(ws, None)
+        if conn is not None:
+            self._unindex(conn)
+        return conn
+
+    def _unindex(self, conn: Connection):
+        if conn.device is None:
+            return
+        if self.by_player.get((conn.name, conn.device)) is conn:
+            del self.by_player[(conn.name, conn.device)]
+        self.by_device[conn.device].pop(conn.ws, None)
+        self.by_role[(conn.role, conn.device)].pop(conn.ws, None)
+        conn.name = conn.device = None
+
+    def names(self, device: str) -> List[str]:
+        return [conn.name for conn in self.by_device[device].values()]
@@ -0,0 +1,223 @@
+"""
+Replays a room recorded with MAFIA_RECORD_DIR through the real handler and
+MafiaGame, with in-memory connections, as fast as possible (or --speed N times
+real time). Inbound messages are fed in their recorded order, one at a time,
+the room gets the recorded RNG seed and head debounce window, and timed events
+(phase deadlines, debounce windows ending) happen where the recording says they
+did, so the outbound traffic should match the recording frame for frame.
+
+    python replay.py recordings/default-20261017-101500-1234.jsonl
+    python replay.py recording.jsonl --profile
+"""
+import argparse
+import asyncio
+import cProfile
+import logging
+import pstats
+import re
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import server
+from recorder import Recording, decode_frame_data, load_recording, mask_tokens
+
+_TOKEN_VALUE = re.compile(r'"token":"([^"]*)"')
+_RESUME_VALUE = re.compile(r'"resume"\s*:\s*"([^"]*)"')
+
+
+class ReplaySocket:
+    """Stands in for a client connection: the handler reads fed frames, sends go nowhere"""
+    def __init__(self, conn_id: int):
+        self.remote_address = ("replay", conn_id)
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.waiting = asyncio.Event()  # the handler is waiting for its next frame
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.waiting.set()
+        frame = await self.inbox.get()
+        self.waiting.clear()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    async def send(self, frame):
+        pass
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        if not self.closed:
+            self.closed = True
+            self.inbox.put_nowait(None)
+
+
+class Replayer:
+    def __init__(self, header: dict, entries: List[list], speed: float):
+        self.header = header
+        self.entries = entries
+        self.speed = speed
+        self.sockets: Dict[int, ReplaySocket] = {}
+        self.handlers: Dict[int, asyncio.Task] = {}
+        self.recording = Recording(header)  # in memory: what this replay sends
+        self.expected: Dict[int, List] = defaultdict(list)  # conn -> recorded outbound frames
+        for entry in entries:
+            if entry[2] == "out":
+                self.expected[entry[1]].append(decode_frame_data(entry[3]))
+        self.tokens: Dict[str, str] = {}  # recorded resume token -> token issued in this replay
+
+    def prepare_room(self):
+        room = server.rooms.get_or_create(self.header["room"])
+        room.game.reseed(self.header["seed"])
+        # Head bursts coalesce as they did live; each window ends at its recorded entry
+        room.heads.window = self.header["debounce"]
+        room.heads.clocked = False
+        room.recording = room.game.recording = self.recording
+        # Phase deadlines fire where the recording says they did, not on the clock
+        room.game.on_deadline = None
+        room.game.cancel_deadline()
+        self.room = room
+
+    async def run(self) -> int:
+        self.prepare_room()
+        started = time.perf_counter()
+        fed = 0
+        for entry in self.entries:
+            seconds, conn_id, kind = entry[0], entry[1], entry[2]
+            if kind == "out":
+                continue
+            if self.speed > 0:
+                await asyncio.sleep(max(0.0, seconds / self.speed - (time.perf_counter() - started)))
+            if kind == "in":
+                await self.feed(conn_id, decode_frame_data(entry[3]))
+                fed += 1
+            elif kind == "deadline":
+                await self.room._expire_phase(*entry[3])
+                for _ in range(3):
+                    await asyncio.sleep(0)
+            elif kind == "window":
+                if entry[3] in self.room.heads.windows:
+                    self.room.heads._close_window(entry[3])
+                for _ in range(3):
+                    await asyncio.sleep(0)
+            elif kind == "close" and conn_id in self.sockets:
+                await self.sockets[conn_id].close()
+                await self.handlers[conn_id]
+        # Connections still open when the recording ended (a live room at shutdown):
+        # hang them up so their handlers and outboxes finish. What the room sends
+        # while they leave happened after the recording, so it isn't compared.
+        self.room.recording = self.room.game.recording = None
+        for ws in self.sockets.values():
+            await ws.close()
+        await asyncio.gather(*self.handlers.values())
+        return fed
+
+    async def feed(self, conn_id: int, frame):
+        ws = self.sockets.get(conn_id)
+        if ws is None:
+            ws = self.sockets[conn_id] = ReplaySocket(conn_id)
+            self.handlers[conn_id] = asyncio.create_task(server.handler(ws))
+        if ws.closed:
+            return
+        if isinstance(frame, str) and '"resume"' in frame:
+            frame = self.rewrite_resume(frame)
+        ws.waiting.clear()
+        ws.inbox.put_nowait(frame)
+        # Wait until the handler is done with this frame (or has hung up)
+        waiting = asyncio.create_task(ws.waiting.wait())
+        await asyncio.wait([waiting, self.handlers[conn_id]], return_when=asyncio.FIRST_COMPLETED)
+        waiting.cancel()
+        # Let tasks it spawned (head debouncer, outbox writers) run before the next frame
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+    def rewrite_resume(self, frame: str) -> str:
+        """Resume tokens are random per run: swap a recorded token for the one this replay issued"""
+        self.learn_tokens()
+        match = _RESUME_VALUE.search(frame)
+        if match and match.group(1) in self.tokens:
+            frame = frame[:match.start(1)] + self.tokens[match.group(1)] + frame[match.end(1):]
+        return frame
+
+    def learn_tokens(self):
+        """Pair up tokens by position: the Nth frame to a connection is the same message in both runs"""
+        for conn_id, frames in self.outbound().items():
+            for recorded, mine in zip(self.expected.get(conn_id, []), frames):
+                if not isinstance(recorded, str) or '"token"' not in recorded:
+                    continue
+                recorded_token, my_token = _TOKEN_VALUE.search(recorded), _TOKEN_VALUE.search(str(mine))
+                if recorded_token and my_token:
+                    self.tokens[recorded_token.group(1)] = my_token.group(1)
+
+    def outbound(self) -> Dict[int, List]:
+        produced: Dict[int, List] = defaultdict(list)
+        for entry in self.recording.lines:
+            if entry[2] == "out":
+                produced[entry[1]].append(decode_frame_data(entry[3]))
+        return produced
+
+    def compare(self) -> int:
+        """Prints where the replay's outbound traffic differs from the recording; returns the mismatch count"""
+        produced = {conn: [mask_tokens(frame) for frame in frames] for conn, frames in self.outbound().items()}
+        mismatches = 0
+        for conn_id in sorted(set(self.expected) | set(produced)):
+            expected = [mask_tokens(frame) for frame in self.expected.get(conn_id, [])]
+            actual = produced.get(conn_id, [])
+            for index, (want, got) in enumerate(zip(expected, actual)):
+                if want != got:
+                    print(f"conn {conn_id} frame {index}: expected {want!r}\n{'':>{len(str(conn_id)) + 6}}got      {got!r}")
+                    mismatches += 1
+                    break
+            else:
+                if len(expected) != len(actual):
+                    print(f"conn {conn_id}: expected {len(expected)} frames, replay sent {len(actual)}")
+                    mismatches += 1
+        return mismatches
+
+
+async def replay(path: str, speed: float) -> int:
+    header, entries = load_recording(path)
+    replayer = Replayer(header, entries, speed)
+    started = time.perf_counter()
+    fed = await replayer.run()
+    elapsed = time.perf_counter() - started
+    recorded = entries[-1][0] if entries else 0.0
+    sent = sum(len(frames) for frames in replayer.outbound().values())
+    print(f"Replayed {fed} inbound frames from room {header['room']} in {elapsed:.3f}s "
+          f"(recorded over {recorded:.1f}s, {recorded / elapsed if elapsed else 0:.0f}x), {sent} frames out")
+    mismatches = replayer.compare()
+    print("Outbound traffic matches the recording" if not mismatches else f"{mismatches} connection(s) differ")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded room through the game server")
+    parser.add_argument("recording", help="a .jsonl file from MAFIA_RECORD_DIR")
+    parser.add_argument("--speed", type=float, default=0, help="N times real time (0: no waiting at all)")
+    parser.add_argument("--profile", action="store_true", help="run under cProfile and print the hottest calls")
+    parser.add_argument("--log", action="store_true", help="show the server's log output")
+    args = parser.parse_args()
+
+    # Replays must not record themselves or spam the console, and feed frames
+    # faster than any client could send them
+    server.RECORD_DIR = ""
+    server.RATE_LIMITS = {}
+    if args.log:
+        server.setup_logging()
+    else:
+        logging.getLogger("mafia").setLevel(logging.WARNING)
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        mismatches = profiler.runcall(asyncio.run, replay(args.recording, args.speed))
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    else:
+        mismatches = asyncio.run(replay(args.recording, args.speed))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
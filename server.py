@@ -1,703 +1,723 @@
 import asyncio
-import random
-from typing import Dict, List
+import atexit
+import importlib.util
+import os
+import secrets
+import signal
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Set
 import websockets
 from websockets.legacy.server import WebSocketServerProtocol
-from util import send_json, parse_json
-
-HOST = "0.0.0.0"
-PORT = 5050
-MAX_PLAYERS = 8
-
-class MafiaGame:
-    
-    async def broadcast_status(self, message: str):
-        # Send a status message to all players
-        for ws, name in self.clients.items():
-            await send_json(ws, name, "status", message)
-    def __init__(self):
-        self.state = "LOBBY"
-        self.expected_signals = {"setup"}
-        self.max_players = MAX_PLAYERS
-
-        self.players: Dict[str, dict] = {}  # name -> player data
-        self.clients: Dict[WebSocketServerProtocol, str] = {}  # ws -> name
-        self.rpis: Dict[WebSocketServerProtocol, str] = {} # name --> ws
-        
-        self.player_id_to_name: Dict[int, str] = {}  # player_id -> name
-        self.name_to_player_id: Dict[str, int] = {}  # name -> player_id
-        
-        self.mafia_name_one = None
-        self.mafia_name_two = None
-        self.doctor_name_one = None
-        self.doctor_name_two = None
-        
-        self.last_killed = None
-        self.last_saved = None
-        self.mafia_count = None
-        self.doctor_count = None
-        self.game_winner = None
-        self.pending_code = -1
-
-    def valid_signal(self, signal):
-        return signal and signal.get("action") in self.expected_signals
-
-    def check_everyone_ready(self):
-        """Check if all players are ready to start (minimum 3 players)"""
-        if len(self.players) < 3:
-            return False
-        return all(p["ready"] for p in self.players.values())
-    
-    def check_everyone_wants_restart(self):
-        """Check if all players want to restart"""
-        if len(self.players) == 0:
+from game import DEFAULT_ROOM, PHASE_DEADLINES, MafiaGame
+from player import Head
+from log import get_logger, setup_logging
+from codec import Message, codec, decode_message
+from protocol import BINARY, decode_binary
+from registry import BROWSER, RPI
+from util import SEND_TIMEOUT, spawn, drop_connection
+from journal import JOURNAL_DIR, Journal
+from recorder import RECORD_DIR, Recording
+from metrics import REGISTRY, MESSAGES, HANDLER_SECONDS, REJECTED, THROTTLED, DEADLINES, RELOADS, METRICS_PORT, TimedLock, start_metrics_server
+from timerwheel import Timer, TimerWheel
+from outbound import OUTBOX_SIZE, OVERFLOW_POLICY
+from ratelimit import RATE_LIMITS, SHED_LAG, LagMonitor, RateLimiter
+from config import ServerConfig, parse_args, install_loop, log_summary
+from workers import WORKERS, WORKER_INDEX, is_worker, owner, owns, route, supervise, worker_port
+
+MAX_ROOMS = 64
+# Seconds over which a player's headUp/headDown bursts collapse into one update (0 = off)
+HEAD_DEBOUNCE_WINDOW = float(os.environ.get("MAFIA_HEAD_DEBOUNCE", "0.25"))
+# Seconds a dropped player's seat is held for them to resume mid-game (0 = remove at once)
+RESUME_GRACE = float(os.environ.get("MAFIA_RESUME_GRACE", "30"))
+# Seconds a draining server waits for games in progress before it stops anyway
+DRAIN_TIMEOUT = float(os.environ.get("MAFIA_DRAIN_TIMEOUT", "1800"))
+# States with no game in progress; a draining server stops once every room is in one
+IDLE_STATES = ("LOBBY", "GAMEOVER")
+
+
+class HeadDebouncer:
+    """
+    Collapses noisy headUp/headDown bursts from each player of a room. The first
+    change is applied right away; anything arriving within the window only
+    updates the player's latest state, which is applied when the window ends.
+    The game only updates when that effective state is new for the current phase.
+    """
+    def __init__(self, room: "Room", window: float = HEAD_DEBOUNCE_WINDOW):
+        self.room = room
+        self.window = window
+        self.latest: Dict[str, Head] = {}  # name -> most recent head state received
+        self.applied: Dict[str, tuple] = {}  # name -> (head, transition_count) last applied
+        self.windows: Dict[str, asyncio.TimerHandle | None] = {}  # name -> end of the open window
+        # Windows end on a timer; replay.py turns this off and ends them where the recording did
+        self.clocked = True
+
+    def push(self, name: str, head: Head):
+        self.latest[name] = head
+        if name in self.windows:
+            return
+        spawn(self.apply(name))
+        if self.window > 0:
+            self.windows[name] = (asyncio.get_running_loop().call_later(self.window, self._close_window, name)
+                                  if self.clocked else None)
+
+    def _close_window(self, name: str):
+        del self.windows[name]
+        if self.room.recording is not None:
+            self.room.recording.window_end(name)
+        if name in self.latest:
+            # Something arrived during the window: apply it and open a new one
+            self.push(name, self.latest[name])
+
+    def forget(self, name: str):
+        timer = self.windows.pop(name, None)
+        if timer:
+            timer.cancel()
+        self.latest.pop(name, None)
+        self.applied.pop(name, None)
+
+    async def apply(self, name: str):
+        async with self.room.lock:
+            head = self.latest.pop(name, None)
+            game = self.room.game
+            if head is None or name not in game.players:
+                return
+            action = "headUp" if head is Head.UP else "headDown"
+            effective = (head, game.transition_count)
+            if self.applied.get(name) == effective or not game.valid_signal(action):
+                return
+            self.applied[name] = effective
+            await game.input_head(name, head)
+
+
+class Room:
+    """One table: an independent MafiaGame guarded by its own lock"""
+    def __init__(self, room_id: str, game: MafiaGame | None = None):
+        self.room_id = room_id
+        self.game = game or MafiaGame(room_id)
+        self.lock = TimedLock()
+        self.heads = HeadDebouncer(self)
+        self.held: Dict[str, Timer] = {}  # name -> grace window end of a seat with no device left
+        self.awaited: Dict[str, Set[str]] = {}  # name -> devices of a held seat not back yet
+        self.log = get_logger("server", room_id)
+        # Inbound/outbound traffic plus the RNG seed, for replay.py
+        self.recording = Recording.open(room_id, self.game.seed, self.heads.window) if RECORD_DIR else None
+        self.game.recording = self.recording
+        self.game.timers = timers
+        self.game.on_deadline = self.phase_deadline
+        self.game.arm_deadline()  # a room restored mid-phase gets a fresh deadline
+
+    def is_empty(self) -> bool:
+        return not self.game.players and not self.game.connections.count(BROWSER) and not self.game.connections.count(RPI)
+
+    async def resume(self, ws: WebSocketServerProtocol, name: str, token: str, is_rpi: bool, binary: bool) -> bool:
+        """
+        Reattach a reconnecting player to their seat if the token matches.
+        Sends a compact catch-up (and any kill/save/vote the rpi still owes)
+        instead of a full registration. Caller holds the lock.
+        """
+        game = self.game
+        player = game.players.get(name)
+        # Bytes: compare_digest() refuses str with non-ASCII characters
+        if player is None or not secrets.compare_digest(player.token.encode(), token.encode()):
             return False
-        return all(p["restart"] for p in self.players.values())
-
-    def check_game_over(self):
-        """Check if game is over and determine winner"""
-        alive_players = [name for name, data in self.players.items() if data["alive"]]
-        
-        # Check if any mafia are alive
-        mafia_alive = self.is_alive(self.mafia_name_one) or self.is_alive(self.mafia_name_two)
-        # If no mafia alive, civilians win
-        if not mafia_alive:
-            return "civilians"
-        
-        # Count alive civilians (non-mafia)
-        alive_civilians = len([name for name in alive_players 
-                              if name != self.mafia_name_one and name != self.mafia_name_two])
-        
-        # If mafia >= civilians, mafia wins
-        alive_mafia_count = sum([
-            1 if self.is_alive(self.mafia_name_one) else 0,
-            1 if self.is_alive(self.mafia_name_two) else 0
-        ])
-        
-        if alive_mafia_count >= alive_civilians:
-            return "mafia"
-        
-        return None  # Game continues
-
-    def reset_game_state(self):
-        """Reset game state for a new round while keeping players"""
-        print("[DEBUG] Resetting game state for new round...")
-        
-        # Reset all player states
-        for player_data in self.players.values():
-            player_data["ready"] = True
-            player_data["restart"] = False
-            player_data["voiceCommand"] = False
-            player_data["head"] = "up"
-            player_data["vote"] = None
-            player_data["kill"] = None
-            player_data["save"] = None
-            player_data["alive"] = True
-        
-        # Reset game variables
-        self.mafia_name_one = None
-        self.mafia_name_two = None
-        self.doctor_name_one = None
-        self.doctor_name_two = None
-        self.last_killed = None
-        self.last_saved = None
-        self.mafia_count = None
-        self.doctor_count = None
-        self.game_winner = None
-        self.pending_code = -1
-        
-        # Back to lobby
-        self.state = "LOBBY"
-        self.expected_signals = {"setup"}
-        
-        print("[DEBUG] Game state reset complete")
-
-    def check_heads_down(self, allowed: List[str | None]):
-        for name, data in self.players.items():
-            print(f"[DEBUG] Checking player {name}'s head state: {data['head']}")
-            if data["alive"] and data["head"] == "up" and name not in allowed:
-                print("[DEBUG] CHECKING HEAD DOWN RETURNING FALSE")
-                return False
+        device = RPI if is_rpi else BROWSER
+        self.device_back(name, device)
+        old = game.attach(ws, name, device, binary)
+        if old is not None:
+            game.forget_connection(old)
+            drop_connection(old, "Session resumed elsewhere")
+        await game.send_to(ws, player.player_id, "resumed", game.catch_up(name, binary))
+        if game.connections.get(ws).deltas:
+            await game.send_status(ws)
+        request = game.pending_request(name) if is_rpi else None
+        if request:
+            await game.request_action(name, request)
+        self.log.info("%s %s resumed their seat in %s", "RPI" if is_rpi else "Player", name, game.state)
         return True
 
-    async def request_action(self, name: str, action: str):
-        print(f"[DEBUG] NAME: {name}")
-        if name == None:
+    def phase_deadline(self, state: str, transition_count: int):
+        """Timer wheel callback: the phase armed at this transition ran out of time"""
+        spawn(self._expire_phase(state, transition_count))
+
+    async def _expire_phase(self, state: str, transition_count: int):
+        async with self.lock:
+            if self.recording is not None:
+                self.recording.deadline(state, transition_count)
+            if await self.game.input_deadline(state, transition_count):
+                self.log.info("%s ran out of time", state)
+                DEADLINES.inc(state)
+
+    def connected(self, name: str) -> bool:
+        """Whether any device of this player is attached"""
+        connections = self.game.connections
+        return connections.of(name, BROWSER) is not None or connections.of(name, RPI) is not None
+
+    def hold_seat(self, name: str, devices: Iterable[str]):
+        """
+        @param devices: the player's devices expected back
+
+        Keep a player's seat for RESUME_GRACE seconds once none of their devices
+        is attached. The seat is released then only if no device came back.
+        """
+        if name not in self.held:
+            self.held[name] = timers.schedule(RESUME_GRACE, lambda: spawn(self._expire_hold(name)))
+        self.awaited.setdefault(name, set()).update(devices)
+
+    def device_back(self, name: str, device: str):
+        """A held seat's device resumed; the hold ends once every awaited device is back"""
+        awaited = self.awaited.get(name)
+        if awaited is not None:
+            awaited.discard(device)
+            if not awaited:
+                self.cancel_hold(name)
+
+    def cancel_hold(self, name: str):
+        self.awaited.pop(name, None)
+        timer = self.held.pop(name, None)
+        if timer:
+            timer.cancel()
+
+    async def _expire_hold(self, name: str):
+        async with self.lock:
+            if self.held.pop(name, None) is None:
+                return  # resumed while the lock was busy
+            self.awaited.pop(name, None)
+            if name in self.game.players and not self.connected(name):
+                self.log.info("%s did not come back within %.0fs", name, RESUME_GRACE)
+                await self.release_seat(name)
+            rooms.discard_if_empty(self)
+
+    async def release_seat(self, name: str):
+        """Remove a player from the table for good. Caller holds the lock."""
+        self.cancel_hold(name)
+        self.heads.forget(name)
+        await self.game.input_leave(name)
+        self.log.info("Player %s removed from game", name)
+
+
+class RoomManager:
+    """Hosts many MafiaGame instances keyed by room ID"""
+    def __init__(self, max_rooms: int = MAX_ROOMS):
+        self.rooms: Dict[str, Room] = {}
+        self.max_rooms = max_rooms
+        self.journal: Journal | None = None
+        self.draining = False  # no new rooms; set by drain()
+
+    def get_or_create(self, room_id: str) -> Room | None:
+        """Return the room with this ID, creating it if there is space and not draining"""
+        room = self.rooms.get(room_id)
+        if room is None:
+            if len(self.rooms) >= self.max_rooms or self.draining:
+                return None
+            room = Room(room_id, MafiaGame(room_id, self.journal))
+            self.rooms[room_id] = room
+            log.info("Created room %s (%d rooms open)", room_id, len(self.rooms))
+        return room
+
+    def idle(self) -> bool:
+        """No room has a game in progress"""
+        return all(room.game.state in IDLE_STATES for room in self.rooms.values())
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {room_id: room.game.to_snapshot() for room_id, room in self.rooms.items()}
+
+    async def recover(self, journal: Journal):
+        """
+        Rebuild every room from the latest snapshot plus the journal tail, then
+        hold all seats so players can resume with their tokens. Snapshots keep
+        the tail short, so this stays fast however long the server has run.
+        """
+        started = time.perf_counter()
+        snapshot, entries = journal.load()
+        devices: Dict[str, dict] = {}  # room -> name -> devices attached at snapshot time
+        for room_id, data in snapshot.items():
+            self.rooms[room_id] = Room(room_id, MafiaGame.from_snapshot(room_id, data))
+            devices[room_id] = data.get("devices", {})
+        replayed = 0
+        for room_id, kind, args in entries:
+            room = self.rooms.get(room_id)
+            # A new game journals its seed first, so a seed for a room we already
+            # have means it was discarded and opened again: start over from here
+            if room is not None and kind == "seed":
+                room.game.cancel_deadline()
+                if room.recording is not None:
+                    room.recording.close()
+                room = None
+                devices.pop(room_id, None)
+            if room is None:
+                room = self.rooms[room_id] = Room(room_id)
+            await room.game.replay(kind, args)
+            replayed += 1
+
+        for room_id, room in list(self.rooms.items()):
+            if not room.game.players:
+                room.game.cancel_deadline()
+                del self.rooms[room_id]
+                continue
+            room.game.journal = journal
+            attached = devices.get(room_id, {})
+            for name in room.game.players:
+                # Players who joined after the snapshot may come back on either device
+                room.hold_seat(name, attached.get(name) or (BROWSER, RPI))
+        self.journal = journal
+        journal.snapshot(self.snapshot())
+        log.info("Recovered %d rooms from %d snapshotted rooms and %d journal entries in %.3fs",
+                 len(self.rooms), len(snapshot), replayed, time.perf_counter() - started)
+
+    async def snapshot_periodically(self):
+        while True:
+            await asyncio.sleep(1)
+            if self.journal.snapshot_due():
+                self.journal.snapshot(self.snapshot())
+
+    def discard_if_empty(self, room: Room):
+        """Drop a room once its last player and connection are gone"""
+        if room.is_empty() and self.rooms.get(room.room_id) is room:
+            del self.rooms[room.room_id]
+            room.game.cancel_deadline()
+            if room.recording is not None:
+                room.recording.close()
+            log.info("Closed room %s (%d rooms open)", room.room_id, len(self.rooms))
+
+
+def room_id_from(msg: Message) -> str:
+    """Read the room ID from a setup message, falling back to the default room"""
+    return msg.room or DEFAULT_ROOM
+
+
+log = get_logger("server")
+rooms = RoomManager()
+# Phase deadlines and seat holds of every room
+timers = TimerWheel()
+loop_lag = LagMonitor()
+
+REGISTRY.gauge("mafia_rooms", "Open rooms", lambda: len(rooms.rooms))
+REGISTRY.gauge("mafia_connected_clients", "Connected browser clients",
+               lambda: sum(room.game.connections.count(BROWSER) for room in rooms.rooms.values()))
+REGISTRY.gauge("mafia_connected_pis", "Connected Raspberry Pis",
+               lambda: sum(room.game.connections.count(RPI) for room in rooms.rooms.values()))
+REGISTRY.gauge("mafia_loop_lag_seconds", "How late the event loop last woke a sleeping task", lambda: loop_lag.lag)
+REGISTRY.gauge("mafia_draining", "1 while the server drains before a restart", lambda: int(rooms.draining))
+REGISTRY.gauge("mafia_timers", "Deadlines and seat holds pending on the timer wheel", lambda: timers.count)
+REGISTRY.gauge("mafia_players", "Seated players",
+               lambda: sum(len(room.game.players) for room in rooms.rooms.values()))
+
+
+class Session:
+    """One client connection: the room it joined at setup, its seat and its wire protocol"""
+    __slots__ = ("ws", "routed", "room", "player_name", "binary", "log", "frame", "limiter")
+
+    def __init__(self, ws: WebSocketServerProtocol, routed: bool):
+        self.ws = ws
+        self.routed = routed  # arrived from another worker, so the room is ours whatever it is
+        self.room: Room | None = None
+        self.player_name: str | None = None
+        self.binary = False  # negotiated at setup, rpis only
+        self.log = log
+        self.frame = None  # raw frame of the message being handled
+        self.limiter = RateLimiter(RATE_LIMITS) if RATE_LIMITS else None
+
+
+@dataclass(slots=True, frozen=True)
+class ActionSpec:
+    """How the handler routes one inbound action"""
+    handler: Callable  # async (session, msg); returns True once it has closed the connection
+    locked: bool = True  # run under the room lock
+    states: frozenset | None = None  # room states that accept it; None for any
+    signal: bool = False  # accepted in the states whose EXPECTED_SIGNALS list it
+    seated: bool = False  # only from a connection that registered a player
+    opens: bool = False  # accepted before setup (setup itself)
+    sheddable: bool = False  # dropped while the event loop is overloaded
+    starts_game: bool = False  # can start a game from the lobby, so refused while draining
+
+    def accepts(self, action: str, game: MafiaGame) -> bool:
+        if self.signal:
+            return game.valid_signal(action)
+        if self.starts_game and rooms.draining and game.state == "LOBBY":
+            return False
+        return self.states is None or game.state in self.states
+
+
+async def on_setup(session: Session, msg: Message) -> bool | None:
+    ws = session.ws
+    room = session.room
+    if room is None:
+        room_id = room_id_from(msg)
+        room = rooms.get_or_create(room_id)
+        if room is None:
+            if rooms.draining:
+                log.info("Draining, not opening room %s", room_id)
+                await ws.close(1013, "Server is restarting")
+                return True
+            log.warning("No room available (%d rooms open)", rooms.max_rooms)
+            await ws.close(1008, "Server is full")
+            return True
+        session.room = room
+        session.log = get_logger("server", room.room_id)
+        if room.recording is not None:
+            room.recording.inbound(ws, session.frame)
+    conn_log = session.log
+    room.game.open_connection(ws).deltas = msg.deltas
+
+    player_name = session.player_name = msg.target
+    is_rpi = player_name == "rpi"
+    if is_rpi:
+        player_name = session.player_name = msg.name
+        session.binary = msg.protocol == BINARY
+    binary = session.binary
+
+    # Reconnecting within the grace window: back to the same seat
+    if msg.resume and player_name:
+        async with room.lock:
+            resumed = await room.resume(ws, player_name, msg.resume, is_rpi, binary)
+        if resumed:
             return
-        ws = self.rpis.get(name)
-        if ws:
-            await send_json(ws, name, action, None)
-
-    def id_to_name(self, player_id: int) -> str | None:
-        """Convert a player ID to player name"""
-        return self.player_id_to_name.get(player_id)
-
-    def name_to_id(self, name: str) -> int | None:
-        """Convert a player name to player ID"""
-        return self.name_to_player_id.get(name)
-
-    def mafia_kill(self):
-        if self.mafia_count == 1:
-            print(f"[DEBUG] pick something")
-            if self.is_alive(self.mafia_name_one) and self.players[self.mafia_name_one]["kill"]:
-                kill = self.players[self.mafia_name_one]["kill"]
-                self.players[self.mafia_name_one]["kill"] = None
-                return kill
-            elif self.is_alive(self.mafia_name_two) and self.players[self.mafia_name_two]["kill"]:
-                    kill = self.players[self.mafia_name_two]["kill"]
-                    self.players[self.mafia_name_two]["kill"] = None
-                    return kill
-            return None
-        elif self.mafia_count == 2:
-            if self.is_alive(self.mafia_name_one) and self.players[self.mafia_name_one]["kill"] and self.is_alive(self.mafia_name_two) and self.players[self.mafia_name_two]["kill"]:
-                if self.players[self.mafia_name_one]["kill"] == self.players[self.mafia_name_two]["kill"]:
-                    kill = self.players[self.mafia_name_one]["kill"]
-                    self.players[self.mafia_name_one]["kill"] = None
-                    self.players[self.mafia_name_two]["kill"] = None
-                    return kill
-            return None
-
-    def doctor_save(self):
-        if self.doctor_count == 1:
-            if self.is_alive(self.doctor_name_one) and self.players[self.doctor_name_one]["save"]:
-                save = self.players[self.doctor_name_one]["save"]
-                self.players[self.doctor_name_one]["save"] = None
-                return save
-            elif self.is_alive(self.doctor_name_two) and self.players[self.doctor_name_two]["save"]:
-                save = self.players[self.doctor_name_two]["save"]
-                self.players[self.doctor_name_two]["save"] = None
-                return save
-            return None
-        elif self.doctor_count == 2:
-            if self.is_alive(self.doctor_name_one) and self.players[self.doctor_name_one]["save"] and self.is_alive(self.doctor_name_two) and self.players[self.doctor_name_two]["save"]:
-                if self.players[self.doctor_name_one]["save"] == self.players[self.doctor_name_two]["save"]:
-                    save = self.players[self.doctor_name_one]["save"]
-                    self.players[self.doctor_name_one]["save"] = None
-                    self.players[self.doctor_name_two]["save"] = None
-                    return save
-            return None
-
-    def everyone_voted(self):
-        for name, data in self.players.items():
-            if data["alive"] and data["vote"] is None:
-                return False
-        return True
-
-    def handle_vote(self):
-        votes = {}
-        for name, data in self.players.items():
-            if data["alive"] and data["vote"]:
-                votes[data["vote"]] = votes.get(data["vote"], 0) + 1
-
-        if not votes:
-            return []
-
-        max_votes = max(votes.values())
-        winners = [name for name, count in votes.items() if count == max_votes]
-
-        # Clear votes
-        for data in self.players.values():
-            data["vote"] = None
-
-        return winners
-
-    def check_role_counts(self):
-        if self.mafia_count == 2:
-            if self.is_alive(self.mafia_name_one) == False or self.is_alive(self.mafia_name_two) == False:
-                self.mafia_count = 1
-        if self.doctor_count == 2:
-            if self.is_alive(self.doctor_name_one) == False or self.is_alive(self.doctor_name_two) == False:
-                self.doctor_count = 1
-
-    def is_alive(self, name: str | None) -> bool:
-        return bool(name) and name in self.players and self.players[name].get("alive")
-
-    async def broadcast(self, action, target=None):
-        for ws, name in self.clients.items():
-            await send_json(ws, name, action, target)
-
-    async def broadcast_lobby_status(self):
-        """Broadcast current lobby status to all players"""
-        ready_count = sum(1 for p in self.players.values() if p["ready"])
-        total_count = len(self.players)
-        for ws, name in self.clients.items():
-            await send_json(ws, name, "lobby_status", {
-                "ready_count": ready_count,
-                "total_count": total_count,
-                "min_players": 3,
-                "max_players": self.max_players,
-                "players": {
-                    pname: pdata["ready"] 
-                    for pname, pdata in self.players.items()
-                }
-            })
-    
-    async def broadcast_restart_status(self):
-        """Broadcast restart status to all players"""
-        restart_count = sum(1 for p in self.players.values() if p["restart"])
-        total_count = len(self.players)
-        
-        for ws, name in self.clients.items():
-            await send_json(ws, name, "restart_status", {
-                "restart_count": restart_count,
-                "total_count": total_count,
-                "players": {
-                    pname: pdata["restart"] 
-                    for pname, pdata in self.players.items()
-                }
-            })
-
-    async def broadcast_vote(self):
-        for name in self.rpis:
-            await self.request_action(name, "vote")
-
-    async def broadcast_game_end(self, winner: str):
-        for ws, name in self.clients.items():
-            await send_json(ws, name, winner, None)
-
-    async def assign_player(self):
-        if self.mafia_count == 2:
-            for ws, name in self.clients.items():
-                role = "civilian"
-                if name == self.mafia_name_one or name == self.mafia_name_two:
-                    role = "mafia"
-                elif name == self.doctor_name_one or name == self.doctor_name_two:
-                    role = "doctor"
-                await send_json(ws, name, role, None)
-            for name, ws in self.rpis.items():
-                role = "civilian"
-                if name == self.mafia_name_one or name == self.mafia_name_two:
-                    role = "mafia"
-                elif name == self.doctor_name_one or name == self.doctor_name_two:
-                    role = "doctor"
-                await send_json(ws, name, role, None)
-        else:
-            for ws, name in self.clients.items():
-                role = "civilian"
-                if name == self.mafia_name_one:
-                    role = "mafia"
-                elif name == self.doctor_name_one:
-                    role = "doctor"
-                await send_json(ws, name, role, None)
-            for name, ws in self.rpis.items():
-                role = "civilian"
-                if name == self.mafia_name_one:
-                    role = "mafia"
-                elif name == self.doctor_name_one:
-                    role = "doctor"
-                await send_json(ws, name, role, None)
-
-    async def update(self):
-        state_before = self.state
-        
-        if self.state == "LOBBY" and self.check_everyone_ready():
-            print(f"[DEBUG] All {len(self.players)} players ready! Starting game...")
-            await self.broadcast_status(f"All {len(self.players)} players ready! Starting game...")
-            if self.pending_code == 2:
-                self.pending_code = -1
-                # Assign roles randomly based on player count
-                player_names = list(self.players.keys())
-                num_players = len(player_names)
-            
-                if num_players >= 7:
-                    self.mafia_count = 2
-                    self.doctor_count = 2
-                    self.mafia_name_one, self.mafia_name_two, self.doctor_name_one, self.doctor_name_two = random.sample(player_names, 4)
+        conn_log.info("Stale resume token from %s, registering again", player_name)
+
+    if is_rpi:
+        conn_log.debug("Adding rpi: %s (%s)", player_name, "binary" if binary else "json")
+
+        async with room.lock:
+            # A hot reload may have swapped the game while this waited for the lock
+            game = room.game
+            # Check if player already exists (from frontend registration)
+            joined = player_name not in game.players
+            if not joined:
+                # Player already exists - link RPI to existing player
+                conn_log.debug("Linking RPI to existing player: %s", player_name)
+                game.attach(ws, player_name, RPI, binary)
+                player_id = game.name_to_player_id.get(player_name)
+                if player_id:
+                    # Send confirmation with existing player ID
+                    # (only the confirmation itself is JSON; binary starts after it)
+                    await game.send_to(ws, player_id, "id_registered", game.registration(player_name, binary))
+                    conn_log.info("RPI linked to existing player %s (ID: %s)", player_name, player_id)
                 else:
-                    self.mafia_count = 1
-                    self.doctor_count = 1
-                    self.mafia_name_one, self.doctor_name_one = random.sample(player_names, 2)
-                
-                print(f"[DEBUG] Assigned roles: Mafia={self.mafia_count}, Doctor={self.doctor_count}")
-                await self.broadcast_status(f"Assigned roles: Mafia={self.mafia_count}, Doctor={self.doctor_count}")
-
-                self.state = "ASSIGN"
-                self.expected_signals = set()
-
-        if self.state == "ASSIGN":
-            await self.assign_player()
-            await self.broadcast("heads_down", None)
-            self.state = "HEADSDOWN"
-            self.expected_signals = {"headUp", "headDown"}
-            print("Moving on to mafia stage, everyone put head down please")
-            await self.broadcast_status("Moving on to mafia stage, everyone put head down please")
-
-# and self.check_heads_down([])
-        if self.state == "HEADSDOWN":
-            self.state = "MAFIAVOTE"
-            self.expected_signals = {"headUp", "headDown", "targeted"}
-            print("MOVING ON TO MAFIA VOTE STAGE")
-            await self.broadcast_status("MOVING ON TO MAFIA VOTE STAGE")
-            if self.mafia_count == 1:
-                if self.players[self.mafia_name_one]["alive"] == True:
-                    await self.request_action(self.mafia_name_one, "kill")
-                    return
-                elif self.players[self.mafia_name_two]["alive"] == True and self.mafia_name_two != None:
-                    await self.request_action(self.mafia_name_two, "kill")
-                    return
-            elif self.mafia_count == 2:
-                await asyncio.gather(
-                    self.request_action(self.mafia_name_one, "kill"), 
-                    self.request_action(self.mafia_name_two, "kill")
-                )
-                return
-                
-        if self.state == "MAFIAVOTE":
- #           if self.check_heads_down([self.mafia_name_one, self.mafia_name_two]):
-                kill = self.mafia_kill()
-                if kill == None and self.mafia_count == 2 and self.players[self.mafia_name_one]["kill"] != None and self.players[self.mafia_name_two]["kill"] != None:
-                    print(f"[DEBUG] voted for diff people, try again")
-                    await self.broadcast_status("Mafia voted for different people, try again.")
-
-                    self.players[self.mafia_name_one]["kill"] = None
-                    self.players[self.mafia_name_two]["kill"] = None
-                    await asyncio.gather(
-                    self.request_action(self.mafia_name_one, "kill"), 
-                    self.request_action(self.mafia_name_two, "kill")
-                    )
-                    return
-                if kill != None:
-                    print(f"[DEBUG] kill successful")      
-                    self.last_killed = kill
-                    self.state = "DOCTORVOTE" if (self.players[self.doctor_name_one]["alive"] or (self.doctor_name_two != None and self.players[self.doctor_name_two]["alive"])) else "NARRATE"
-                    if self.state == "DOCTORVOTE":
-                        if self.doctor_count == 1:
-                            if self.players[self.doctor_name_one]["alive"] == True:
-                                await self.request_action(self.doctor_name_one, "save")
-                                return
-                            elif self.players[self.doctor_name_two]["alive"] == True and self.doctor_name_two != None:
-                                await self.request_action(self.doctor_name_two, "save")
-                                return
-                        elif self.doctor_count == 2:
-                            await asyncio.gather(
-                                self.request_action(self.doctor_name_one, "save"), 
-                                self.request_action(self.doctor_name_two, "save")
-                            )
-                            return
-
-        if self.state == "DOCTORVOTE":
- #           if self.check_heads_down([self.doctor_name_one, self.doctor_name_two]):
-                save = self.doctor_save()
-                if save == None and self.doctor_count == 2 and self.players[self.doctor_name_one]["save"] != None and self.players[self.doctor_name_two]["save"] != None:
-                    print(f"[DEBUG] voted for diff people, try again")
-                    await self.broadcast_status("Doctor voted for different people, try again.")
-                    self.players[self.doctor_name_one]["save"] = None
-                    self.players[self.doctor_name_two]["save"] = None
-                    await asyncio.gather(
-                    self.request_action(self.doctor_name_one, "save"), 
-                    self.request_action(self.doctor_name_two, "save")
-                    )
-                    return
-                if save != None:
-                    self.last_saved = save
-                    if self.last_saved != self.last_killed:
-                        print(f"[DEBUG] save failed")
-                        await self.broadcast_status("Doctor save failed.")
-                        self.players[self.last_killed]["alive"] = False
-                        self.check_role_counts()
-                    self.state = "NARRATE"
-
-        if self.state == "NARRATE":
-            print("[DEBUG] Narrating night results...")
-            await self.broadcast_status("Narrating night results...")
-            await self.broadcast("night_result", {
-                "killed": self.last_killed,
-                "saved": self.last_saved
-            })
-            self.last_saved = None
-            self.last_killed = None
-            # Check if game is over after night
-            winner = self.check_game_over()
-            if winner:
-                self.game_winner = winner
-                self.state = "GAMEOVER"
-                self.expected_signals = set()
-                await self.broadcast("game_over", {
-                    "winner": winner,
-                    "mafia": [self.mafia_name_one, self.mafia_name_two] if self.mafia_count == 2 else [self.mafia_name_one]
-                })
-                await self.broadcast_restart_status()
-                return
-            
-            self.state = "PREVOTE"
-            self.expected_signals = {"targeted"}
-            print("[DEBUG] Moving to day voting stage")
-            await self.broadcast_status("Moving to day voting stage.")
-
-        if self.state == "PREVOTE":
-            if self.pending_code == 3:
-                self.pending_code = -1
-                self.state = "VOTE"
-                await self.broadcast_vote()
-
-        if self.state == "VOTE" and self.everyone_voted():
-            voted_out = self.handle_vote()
-            if len(voted_out) != 1:
-                print(f"[DEBUG] Vote tied between {[player for player in voted_out]}")
-                await self.broadcast_status(f"Vote tied between {[player for player in voted_out]}")
-                await self.broadcast("vote_result_tie", voted_out)
-                self.state = "HEADSDOWN"
-                self.expected_signals = {"headUp", "headDown"}
-                print("[DEBUG] Moving back to night phase")
-                await self.broadcast_status("Moving back to night phase.")
-                await self.broadcast("heads_down", None)
-                return
-            
-            print(f"[DEBUG] Player voted out: {voted_out[0]}")
-            await self.broadcast_status(f"Player voted out: {voted_out[0]}")
-            self.players[voted_out[0]]["alive"] = False
-            self.check_role_counts()
-            await self.broadcast("vote_result", voted_out)
-            
-            # Check if game is over after vote
-            winner = self.check_game_over()
-            if winner:
-                self.game_winner = winner
-                self.state = "GAMEOVER"
-                self.expected_signals = set()
-                await self.broadcast("game_over", {
-                    "winner": winner,
-                    "mafia": [self.mafia_name_one, self.mafia_name_two] if len(self.players) >= 7 else [self.mafia_name_one]
-                })
-                await self.broadcast_restart_status()
-                return
-            
-            self.state = "HEADSDOWN"
-            self.expected_signals = {"headUp", "headDown"}
-            print("[DEBUG] Moving back to night phase")
-            await self.broadcast_status("Moving back to night phase.")
-            await self.broadcast("heads_down", voted_out)
-            
-        if self.state == "GAMEOVER" and self.check_everyone_wants_restart():
-            print("[DEBUG] All players want to restart! Restarting game...")
-            await self.broadcast_status("All players want to restart! Restarting game...")
-            self.reset_game_state()
-            await self.broadcast_lobby_status()
-        
-        # If state changed, recursively call update to continue processing
-        if self.state != state_before:
-            print(f"[DEBUG] State changed from {state_before} to {self.state}, continuing update...")
-            await self.broadcast_status(f"State changed from {state_before} to {self.state}, continuing update...")
-            await self.update()
-
-
-# ------------------ SERVER ------------------
-
-game = MafiaGame()
-lock = asyncio.Lock()
-
-
-async def handler(ws: WebSocketServerProtocol):
-    player_name = None
-    
+                    conn_log.warning("Player %s exists but has no ID", player_name)
+            else:
+                # New player registration via RPI
+                if len(game.players) >= game.max_players:
+                    conn_log.info("Game is full (%d players)", game.max_players)
+                    await ws.close(1008, "Game is full")
+                    return True
+
+                player_id = game.next_player_id
+
+                # Register RPI player
+                await game.input_join(player_name, player_id)
+                game.attach(ws, player_name, RPI, binary)
+
+                # Send confirmation
+                await game.send_to(ws, player_id, "id_registered", game.registration(player_name, binary))
+                conn_log.info("RPI Player %s registered with ID %s", player_name, player_id)
+
+        # Broadcast lobby status to all players (linking a pi to a seat changes nothing)
+        if joined:
+            await room.game.broadcast_lobby_status({"join": player_name})
+        return
+    conn_log.debug("Adding player: %s", player_name)
+
+    async with room.lock:
+        game = room.game
+        if player_name in game.players:
+            conn_log.info("Name %s already taken", player_name)
+            await ws.close(1008, "Name already taken")
+            return True
+
+        if len(game.players) >= game.max_players:
+            conn_log.info("Game is full (%d players)", game.max_players)
+            await ws.close(1008, "Game is full")
+            return True
+
+        player_id = game.next_player_id
+
+        # Register player (NOT ready by default)
+        await game.input_join(player_name, player_id)
+        game.attach(ws, player_name, BROWSER)
+        registered = game.registration(player_name)
+
+    # Send confirmation
+    await game.send_to(ws, player_id, "id_registered", registered)
+    conn_log.info("Player %s registered with ID %s", player_name, player_id)
+
+    # Broadcast lobby status to all players
+    await room.game.broadcast_lobby_status({"join": player_name})
+
+
+async def on_voice(session: Session, msg: Message):
+    """Control messages (voice commands from frontend)"""
+    code = msg.target_id if msg.target_id is not None else msg.target
+    session.log.debug("Voice command from %s: code=%s", session.player_name, code)
+    await session.room.game.input_voice(code)
+
+
+async def on_resync(session: Session, msg: Message):
+    """A delta client saw a gap in the seq numbers and wants the full status again"""
+    await session.room.game.send_status(session.ws)
+
+
+async def on_ready(session: Session, msg: Message):
+    game = session.room.game
+    if session.player_name in game.players:
+        session.log.debug("Player %s is ready", session.player_name)
+        await game.input_ready(session.player_name)
+
+
+async def on_restart(session: Session, msg: Message):
+    game = session.room.game
+    if session.player_name in game.players:
+        session.log.debug("Player %s wants to restart", session.player_name)
+        await game.input_restart(session.player_name)
+
+
+async def on_head(session: Session, msg: Message):
+    """Coalesced per player; the debouncer takes the lock when it applies"""
+    session.log.debug("Received signal %s", msg)
+    session.room.heads.push(session.player_name, Head.UP if msg.action == "headUp" else Head.DOWN)
+
+
+async def on_target(session: Session, msg: Message):
+    game = session.room.game
+    session.log.debug("Received signal %s", msg)
+    if session.player_name not in game.players:
+        return
+    target = msg.target
+    if msg.target_id is not None:
+        target = game.id_to_name(msg.target_id)
+        if target is None:
+            session.log.debug("Invalid player ID received: %s", msg.target)
+            return
+    await game.input_target(session.player_name, target)
+
+
+# Inbound action -> how to handle it. Anything not listed is ignored, and an
+# action the room's current state doesn't accept is dropped before it waits
+# for the room lock.
+DISPATCH: Dict[str, ActionSpec] = {
+    # Takes the lock itself, around each registration step
+    "setup": ActionSpec(on_setup, locked=False, opens=True),
+    "voiceCommand": ActionSpec(on_voice, starts_game=True),
+    "ready": ActionSpec(on_ready, states=frozenset({"LOBBY"}), seated=True, starts_game=True),
+    "restart": ActionSpec(on_restart, states=frozenset({"GAMEOVER"}), seated=True),
+    # Never shed: clients send a head event only when the head flips
+    "headUp": ActionSpec(on_head, locked=False, signal=True, seated=True),
+    "headDown": ActionSpec(on_head, locked=False, signal=True, seated=True),
+    # Shed under load: a client whose resync is dropped asks again at the next gap
+    "resync": ActionSpec(on_resync, sheddable=True),
+    "targeted": ActionSpec(on_target, signal=True, seated=True),
+}
+
+
+async def handler(ws: WebSocketServerProtocol, routed: bool = False):
+    """
+    @param routed: arrived from another worker, so the room is ours whatever it is
+    """
+    session = Session(ws, routed)
+
     try:
         async for message in ws:
-            msg = parse_json(message)
-            if not msg:
-                continue
-            
-            # Handle control messages (voice commands from frontend)
-            if msg.get("action") == "voiceCommand":
-                code = msg.get("target")
-                
-                if isinstance(code, str) and code.isnumeric():
-                    code = int(code)
-                
-                async with lock:
-                    game.pending_code = code
-                    print(f"[VOICE_COMMAND] Received: player={player_name}, code={2}")
-                    await game.update()
-                continue
-            
-            # Handle setup message
-            if msg.get("action") == "setup":
-                player_name = msg.get("target")
-                if player_name == "rpi":
-                    player_name = msg.get("name")
-                    print(f"[DEBUG] server adding rpi: {player_name}")
-                    
-                    async with lock:
-                        # Check if player already exists (from frontend registration)
-                        if player_name in game.players:
-                            # Player already exists - link RPI to existing player
-                            print(f"[DEBUG] Linking RPI to existing player: {player_name}")
-                            game.rpis[player_name] = ws
-                            player_id = game.name_to_player_id.get(player_name)
-                            if player_id:
-                                # Send confirmation with existing player ID
-                                await send_json(ws, player_id, "id_registered", None)
-                                print(f"[DEBUG] RPI linked to existing player {player_name} (ID: {player_id})")
-                            else:
-                                print(f"[DEBUG] Warning: Player {player_name} exists but has no ID")
-                        else:
-                            # New player registration via RPI
-                            if len(game.players) >= game.max_players:
-                                print(f"[DEBUG] Game is full ({game.max_players} players)")
-                                await ws.close(1008, "Game is full")
-                                return
-
-                            player_id = len(game.players) + 1
-                            game.player_id_to_name[player_id] = player_name
-                            game.name_to_player_id[player_name] = player_id
-
-                            # Register RPI player
-                            game.rpis[player_name] = ws
-                            game.players[player_name] = {
-                                "setup": True,
-                                "ready": False,
-                                "restart": False,
-                                "voiceCommand": False,
-                                "head": "up",
-                                "vote": None,
-                                "kill": None,
-                                "save": None,
-                                "alive": True
-                            }
-                            
-                            # Send confirmation
-                            await send_json(ws, player_id, "id_registered", None)
-                            print(f"[DEBUG] RPI Player {player_name} registered successfully with ID {player_id}")
-                    
-                    # Broadcast lobby status to all players
-                    await game.broadcast_lobby_status()
+            room = session.room
+            if session.binary and isinstance(message, bytes):
+                frame = decode_binary(message)
+                msg = Message(frame.action, frame.target) if frame else None
+            else:
+                msg = decode_message(message)
+            if msg is not None:
+                action = msg.action
+                spec = DISPATCH.get(action)
+                # Unknown actions share one label so clients can't grow the metric without bound
+                label = action if spec is not None else "other"
+                MESSAGES.inc(label)
+                # Dropped before they are recorded, so replays see only what the room handled
+                if session.limiter is not None and not session.limiter.allow(action):
+                    THROTTLED.inc(label, "rate")
+                    if session.limiter.dropped == 1:
+                        session.log.info("Throttling %s (%s)", session.player_name or "connection", action)
                     continue
-                print(f"[DEBUG] server adding player: {player_name}")
-                
-                async with lock:
-                    if player_name in game.players:
-                        print(f"[DEBUG] Name {player_name} already taken")
-                        await ws.close(1008, "Name already taken")
-                        return
-                    
-                    if len(game.players) >= game.max_players:
-                        print(f"[DEBUG] Game is full ({game.max_players} players)")
-                        await ws.close(1008, "Game is full")
-                        return
-
-                    player_id = len(game.players) + 1
-                    game.player_id_to_name[player_id] = player_name
-                    game.name_to_player_id[player_name] = player_id
-
-                    # Register player (NOT ready by default)
-                    game.clients[ws] = player_name
-                    game.players[player_name] = {
-                        "setup": True,
-                        "ready": False,
-                        "restart": False,
-                        "voiceCommand": False,
-                        "head": "up",
-                        "vote": None,
-                        "kill": None,
-                        "save": None,
-                        "alive": True
-                    }
-                
-                # Send confirmation
-                await send_json(ws, player_id, "id_registered", None)
-                print(f"[DEBUG] Player {player_name} registered successfully with ID {player_id}")
-                
-                # Broadcast lobby status to all players
-                await game.broadcast_lobby_status()
-                continue
-            
-            # Handle ready signal
-            if msg.get("action") == "ready":
-                async with lock:
-                    if player_name and player_name in game.players:
-                        game.players[player_name]["ready"] = True
-                        print(f"[DEBUG] Player {player_name} is ready!")
-                        
-                        # Broadcast updated lobby status
-                        await game.broadcast_lobby_status()
-                        
-                        # Try to start the game
-                        await game.update()
+                if spec is not None and spec.sheddable and loop_lag.overloaded:
+                    THROTTLED.inc(label, "overload")
+                    continue
+            if room is not None and room.recording is not None:
+                room.recording.inbound(ws, message)
+            if msg is None:
                 continue
-            
-            # Handle restart signal
-            if msg.get("action") == "restart":
-                async with lock:
-                    if player_name and player_name in game.players and game.state == "GAMEOVER":
-                        game.players[player_name]["restart"] = True
-                        print(f"[DEBUG] Player {player_name} wants to restart!")
-                        
-                        # Broadcast updated restart status
-                        await game.broadcast_restart_status()
-                        
-                        # Try to restart the game
-                        await game.update()
+            session.frame = message
+            if spec is None:
+                session.log.debug("Ignoring unknown action %s", action)
                 continue
-
-            # Handle other game signals
-            if player_name and game.valid_signal(msg):
-                action = msg["action"]
-                print(f"received signal {msg}")
-                async with lock:
-                    if player_name not in game.players:
+            if room is None and spec.opens and not session.routed:
+                room_id = room_id_from(msg)
+                if not owns(room_id):
+                    # Relayed for the rest of the connection, so kept out of the setup timings
+                    await route(ws, message, owner(room_id))
+                    return
+            with HANDLER_SECONDS.time(label):
+                if room is None:
+                    # Every other message is scoped to the room joined at setup
+                    if not spec.opens:
+                        session.log.debug("Ignoring %s before setup", action)
                         continue
-                    
-                    player_data = game.players[player_name]
-                    
-                    if action == "headUp":
-                        player_data["head"] = "up"
-                    elif action == "headDown":
-                        player_data["head"] = "down"
-                    elif action == "targeted":
-                        target = msg.get("target")
-                        print(f"[DEBUG], received target signal with target: {target}, of type: {type(target)}")
-
-                        if isinstance(target, str) and target.isnumeric():
-                            target = int(target)
-                            target = game.id_to_name(target)
-                            if target is None:
-                                print(f"[DEBUG] Invalid player ID received: {msg.get('target')}")
-                                continue
-                        
-                        if (player_name == game.mafia_name_one or player_name == game.mafia_name_two) and game.state == "MAFIAVOTE":
-                            player_data["kill"] = target
-                            print(f"[DEBUG] {player_name} voted to kill: {target}")
-                        elif (player_name == game.doctor_name_one or player_name == game.doctor_name_two) and game.state == "DOCTORVOTE":
-                            player_data["save"] = target
-                            print(f"[DEBUG] {player_name} voted to save: {target}")
-                        else:
-                            player_data["vote"] = target
-                            print(f"[DEBUG] {player_name} voted for: {target}")
-
-                await game.update()
+                elif not spec.accepts(action, room.game):
+                    REJECTED.inc(label)
+                    session.log.debug("Ignoring %s in %s", action, room.game.state)
+                    continue
+                if spec.seated and not session.player_name:
+                    continue
+
+                if not spec.locked:
+                    done = await spec.handler(session, msg)
+                else:
+                    async with room.lock:
+                        # The room may have moved on while this waited for the lock
+                        if not spec.accepts(action, room.game):
+                            REJECTED.inc(label)
+                            continue
+                        done = await spec.handler(session, msg)
+                if done:
+                    return
 
     except websockets.exceptions.ConnectionClosedError:
-        print(f"[DEBUG] Connection closed unexpectedly for player: {player_name}")
-    except Exception as e:
-        print(f"[ERROR] Handler error for {player_name}: {e}")
-        import traceback
-        traceback.print_exc()
+        session.log.info("Connection closed unexpectedly for player: %s", session.player_name)
+    except Exception:
+        session.log.exception("Handler error for %s", session.player_name)
     finally:
-        if player_name:
-            print(f"[DEBUG] Cleaning up player {player_name}")
-            async with lock:
-                if ws in game.clients:
-                    del game.clients[ws]
-                if player_name in game.players:
-                    player_id = game.name_to_player_id.get(player_name)
-                    if player_id is not None:
-                        del game.player_id_to_name[player_id]
-                        del game.name_to_player_id[player_name]
-                    del game.players[player_name]
-                
-                game.check_role_counts()
-                # Broadcast updated lobby status if still in lobby
-                if game.state == "LOBBY":
-                    await game.broadcast_lobby_status()
-                elif game.state == "GAMEOVER":
-                    await game.broadcast_restart_status()
-                    
-            print(f"[DEBUG] Player {player_name} removed from game")
-
-async def main():
-    async with websockets.serve(handler, HOST, PORT, ping_interval=30,ping_timeout=30):
-        print(f"WebSocket server running on {PORT}")
-        await asyncio.Future()
+        room, player_name = session.room, session.player_name
+        if room is not None:
+            if room.recording is not None:
+                room.recording.closed(ws)
+            async with room.lock:
+                game = room.game
+                # Only the seat's current connection counts; one replaced by a resume doesn't
+                conn = game.connections.get(ws)
+                attached = conn is not None and conn.device is not None
+                device = conn.device if attached else None
+                game.forget_connection(ws)
+                if attached and player_name in game.players:
+                    if game.state != "LOBBY" and RESUME_GRACE > 0:
+                        # The seat stays taken while the player's other device is still here
+                        if not room.connected(player_name):
+                            session.log.info("Holding %s's seat for %.0fs", player_name, RESUME_GRACE)
+                            room.hold_seat(player_name, (device,))
+                    else:
+                        session.log.debug("Cleaning up player %s", player_name)
+                        await room.release_seat(player_name)
+
+                rooms.discard_if_empty(room)
+
+async def drain(stop: asyncio.Future):
+    """
+    Stop opening rooms and starting games, let the games in progress finish
+    (for up to DRAIN_TIMEOUT seconds), then stop the server
+    """
+    if rooms.draining:
+        return
+    rooms.draining = True
+    log.info("Draining: %d rooms open, no new rooms or games", len(rooms.rooms))
+    for room in list(rooms.rooms.values()):
+        async with room.lock:
+            if room.game.state == "LOBBY":
+                await room.game.broadcast_status("Server is restarting, new games can start in a moment")
+    loop = asyncio.get_running_loop()
+    give_up_at = loop.time() + DRAIN_TIMEOUT
+    while not rooms.idle() and loop.time() < give_up_at:
+        await asyncio.sleep(1)
+    if rooms.idle():
+        log.info("Drained, stopping")
+    else:
+        log.warning("Drain timed out after %.0fs with games in progress, stopping anyway", DRAIN_TIMEOUT)
+    if not stop.done():
+        stop.set_result(None)
+
+
+def load_game_logic():
+    """A fresh copy of game.py as it is on disk now; the running module is left alone"""
+    spec = importlib.util.find_spec("game")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def reload_game_logic() -> bool:
+    """
+    Swap in the game logic from game.py on disk without dropping anyone. Each
+    room is rebuilt on the new MafiaGame from a snapshot of its game, keeping
+    its connections, timers and journal. If the new code fails to import or to
+    rebuild any room, every room keeps running the old code.
+    """
+    global MafiaGame
+    try:
+        module = load_game_logic()
+        # Dry run first, so a bad build can't leave rooms on two versions
+        for room in list(rooms.rooms.values()):
+            module.MafiaGame.adopt(room.game)
+    except Exception:
+        log.exception("Reloading game logic failed, keeping the running version")
+        RELOADS.inc("failed")
+        return False
+    # New rooms get the new code from here on
+    sys.modules["game"] = module
+    MafiaGame = module.MafiaGame
+    for room in list(rooms.rooms.values()):
+        async with room.lock:
+            if not isinstance(room.game, MafiaGame):
+                room.game = MafiaGame.adopt(room.game)
+    RELOADS.inc("ok")
+    log.info("Reloaded game logic in %d rooms", len(rooms.rooms))
+    return True
+
+
+async def main(config: ServerConfig):
+    await recover_rooms()
+    spawn(loop_lag.run())
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    # Rolling out a fix: SIGHUP reloads the game logic in place, SIGUSR1 drains and stops
+    loop.add_signal_handler(signal.SIGHUP, lambda: spawn(reload_game_logic()))
+    loop.add_signal_handler(signal.SIGUSR1, lambda: spawn(drain(stop)))
+    options = config.serve_kwargs()
+    if not is_worker():
+        async with websockets.serve(handler, config.host, config.port, **options):
+            log.info("WebSocket server running on %s", config.port)
+            await start_metrics_server()
+            await stop
+        return
+
+    # One of several workers: all share the public port, and each has a loopback
+    # port the others relay connections for its rooms to
+    routed_options = dict(options, ping_interval=None)
+    async with websockets.serve(handler, config.host, config.port, reuse_port=True, **options), \
+            websockets.serve(lambda ws: handler(ws, routed=True), "127.0.0.1", worker_port(WORKER_INDEX), **routed_options):
+        log.info("Worker %d of %d running on %s (routed port %s)", WORKER_INDEX, WORKERS, config.port, worker_port(WORKER_INDEX))
+        await start_metrics_server(port=METRICS_PORT + WORKER_INDEX if METRICS_PORT else 0)
+        await stop
+
+
+async def recover_rooms():
+    """Rebuild rooms from the journal and keep journaling, if MAFIA_JOURNAL_DIR is set"""
+    if not JOURNAL_DIR:
+        return
+    # Each worker journals the rooms it owns in its own directory
+    journal = Journal(os.path.join(JOURNAL_DIR, f"worker-{WORKER_INDEX}") if is_worker() else JOURNAL_DIR)
+    await rooms.recover(journal)
+    journal.start()
+    atexit.register(journal.close)
+    spawn(rooms.snapshot_periodically())
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    setup_logging()
+    config = parse_args()
+    loop = install_loop(config.loop)
+    if not is_worker():
+        log_summary(config, loop, workers=WORKERS, codec=codec.name, journal=JOURNAL_DIR or "off",
+                    recordings=RECORD_DIR or "off", metrics_port=METRICS_PORT or "off", resume_grace=RESUME_GRACE,
+                    phase_deadlines=PHASE_DEADLINES or "off", rate_limits=RATE_LIMITS or "off",
+                    shed_lag=SHED_LAG or "off", outbox=f"{OUTBOX_SIZE} frames, {OVERFLOW_POLICY}",
+                    send_timeout=SEND_TIMEOUT, drain_timeout=DRAIN_TIMEOUT)
+    if WORKERS > 1 and not is_worker():
+        supervise(WORKERS)
+    else:
+        asyncio.run(main(config))
@@ -0,0 +1,33 @@
+import pytest
+
+import codec
+from codec import BACKENDS, decode_message
+
+GARBAGE = ["", "{", "not json", '{"action":', "[1, 2", b"\xff\xfe\x00", b'{"action": "ready"', None]
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request, monkeypatch):
+    try:
+        selected = BACKENDS[request.param]()
+    except ImportError:
+        pytest.skip(f"{request.param} is not installed")
+    monkeypatch.setattr(codec, "codec", selected)
+    return selected
+
+
+@pytest.mark.parametrize("frame", GARBAGE)
+def test_backend_raises_its_own_errors(backend, frame):
+    with pytest.raises(backend.errors):
+        backend.loads(frame)
+
+
+@pytest.mark.parametrize("frame", GARBAGE)
+def test_decode_message_rejects_garbage(backend, frame):
+    assert decode_message(frame) is None
+
+
+def test_decode_message_accepts_valid_frame(backend):
+    message = decode_message('{"action": "targeted", "target": 3.0}')
+    assert message.action == "targeted"
+    assert message.target_id == 3
@@ -0,0 +1,22 @@
+from game import TRANSITIONS, parse_deadlines
+
+DEADLINE_STATES = {state for state, event in TRANSITIONS if event == "deadline"}
+
+
+def test_deadline_states_are_the_vote_phases():
+    assert DEADLINE_STATES == {"MAFIAVOTE", "DOCTORVOTE", "VOTE"}
+
+
+def test_parses_deadlines():
+    assert parse_deadlines("mafiavote=60, DOCTORVOTE=60,VOTE=120.5", DEADLINE_STATES) == {
+        "MAFIAVOTE": 60.0, "DOCTORVOTE": 60.0, "VOTE": 120.5}
+
+
+def test_skips_states_without_a_deadline_transition():
+    assert parse_deadlines("VOTE=10,PREVOTE=0.3,NOPE=5", DEADLINE_STATES) == {"VOTE": 10.0}
+
+
+def test_skips_values_that_are_not_positive_seconds():
+    spec = "VOTE=abc,MAFIAVOTE=0,DOCTORVOTE=-5"
+    assert parse_deadlines(spec, DEADLINE_STATES) == {}
+    assert parse_deadlines("VOTE=,MAFIAVOTE=nan,DOCTORVOTE=inf", DEADLINE_STATES) == {}
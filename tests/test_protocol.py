@@ -0,0 +1,38 @@
+import ast
+
+import protocol
+from game import MafiaGame
+from protocol import Frame, decode_binary, encode_binary
+
+
+def test_binary_round_trip():
+    assert decode_binary(encode_binary("targeted", 3, 5)) == Frame("targeted", 3, 5)
+    assert decode_binary(encode_binary("status", 2, "Night falls")) == Frame("status", 2, "Night falls")
+    assert decode_binary(encode_binary("headUp", 1)) == Frame("headUp", 1, None)
+
+
+def test_malformed_frames():
+    assert decode_binary(b"\x01") is None
+    assert decode_binary(b"\xff\x01\x00") is None
+    assert decode_binary(b"\x10\x01\x00\xff") is None
+
+
+def test_protocol_imports_only_the_stdlib():
+    with open(protocol.__file__, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    imported = {alias.name for node in ast.walk(tree) if isinstance(node, ast.Import) for alias in node.names}
+    imported |= {node.module for node in ast.walk(tree) if isinstance(node, ast.ImportFrom)}
+    assert imported == {"struct", "typing"}
+
+
+def test_player_ids_are_not_reused():
+    game = MafiaGame("ids")
+    for name in ("a", "b", "c"):
+        game.add_player(name, game.next_player_id)
+    game.remove_player("b")
+    game.add_player("d", game.next_player_id)
+    assert game.name_to_player_id == {"a": 1, "c": 3, "d": 4}
+    restored = MafiaGame.from_snapshot("ids", game.to_snapshot())
+    game.remove_player("d")
+    assert MafiaGame.from_snapshot("ids", game.to_snapshot()).next_player_id == 5
+    assert restored.next_player_id == 5
@@ -0,0 +1,25 @@
+import recorder
+from recorder import Recording, load_recording
+
+
+def test_recording_is_written_off_the_loop_and_stops_at_close(tmp_path):
+    recording = Recording.open("room 1", seed=42, debounce=0.25, directory=str(tmp_path))
+    ws = object()
+    recording.inbound(ws, '{"action":"ready"}')
+    recording.window_end("alice")
+    recording.close()
+    recording.outbound(ws, "after close")
+    recorder._writer.stop()
+
+    (path,) = tmp_path.iterdir()
+    header, entries = load_recording(str(path))
+    assert header["room"] == "room 1" and header["debounce"] == 0.25
+    assert [entry[1:] for entry in entries] == [[1, "in", '{"action":"ready"}'], [0, "window", "alice"]]
+
+
+def test_in_memory_recording_stops_growing_after_close():
+    recording = Recording({"room": "r"})
+    recording.inbound(object(), "x")
+    recording.close()
+    recording.inbound(object(), "y")
+    assert len(recording.lines) == 1
@@ -0,0 +1,41 @@
+import asyncio
+import json
+
+from game import MafiaGame
+from registry import BROWSER
+
+
+class ListOutbox:
+    """Stands in for Outbox: keeps the actions of the frames it was given"""
+    def __init__(self):
+        self.actions = []
+
+    def put(self, frame, droppable: bool = False) -> bool:
+        self.actions.append(json.loads(frame)["action"])
+        return True
+
+
+def seat(game: MafiaGame, name: str) -> ListOutbox:
+    ws, outbox = object(), ListOutbox()
+    game.add_player(name, game.next_player_id)
+    game.connections.open(ws, outbox).deltas = True
+    game.attach(ws, name, BROWSER)
+    return outbox
+
+
+def test_kind_change_sends_full_status():
+    game = MafiaGame("deltas")
+    alice = seat(game, "alice")
+
+    async def run():
+        await game.broadcast_lobby_status()
+        await game.broadcast_lobby_status({"ready": "alice"})
+        await game.broadcast_restart_status()
+        await game.broadcast_restart_status({"restart": "alice"})
+        # A join during GAMEOVER: alice holds restart_status, so no lobby_delta
+        await game.broadcast_lobby_status({"join": "bob"})
+        await game.broadcast_lobby_status({"ready": "bob"})
+
+    asyncio.run(run())
+    assert alice.actions == ["lobby_status", "lobby_delta", "restart_status", "restart_delta",
+                             "lobby_status", "lobby_delta"]
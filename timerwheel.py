@@ -0,0 +1,98 @@
+import asyncio
+import math
+import os
+from typing import Callable, List, Set
+
+from log import get_logger
+
+# Wheel resolution in seconds; timers fire up to one tick late, never early
+TIMER_TICK = float(os.environ.get("MAFIA_TIMER_TICK", "0.1"))
+# Slots per revolution; longer delays just go round the wheel more than once
+TIMER_SLOTS = 512
+
+log = get_logger("timers")
+
+
+class Timer:
+    """Handle for one scheduled callback; cancel() works like asyncio.TimerHandle.cancel()"""
+    __slots__ = ("wheel", "slot", "rounds", "callback", "args", "cancelled")
+
+    def __init__(self, wheel: "TimerWheel", slot: int, rounds: int, callback: Callable, args: tuple):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds  # full revolutions left before it fires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.wheel._remove(self)
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: one slot per tick, each holding the timers due when the
+    cursor reaches it. Scheduling and cancelling are O(1) and a tick only touches
+    one slot, so thousands of rooms with deadlines cost a single loop callback per
+    tick, and nothing at all while no timer is pending.
+
+    Callbacks are plain functions run on the event loop; use spawn() from them
+    for anything async.
+    """
+    def __init__(self, tick: float = TIMER_TICK, slots: int = TIMER_SLOTS):
+        self.tick = tick
+        self.slots: List[Set[Timer]] = [set() for _ in range(slots)]
+        self.cursor = 0
+        self.count = 0
+        self._next_at = 0.0  # loop time of the next tick
+        self._handle: asyncio.TimerHandle | None = None
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        """
+        @param delay: seconds from now, rounded up to the next tick
+        @param callback: called as callback(*args) once the delay has passed
+        """
+        loop = asyncio.get_running_loop()
+        if self._handle is None:
+            # Idle until now: restart the clock from this moment
+            self._next_at = loop.time() + self.tick
+            self._handle = loop.call_at(self._next_at, self._advance)
+        # Slot cursor+n fires at _next_at + (n - 1) * tick; take the first one not before the delay
+        ticks = max(1, math.ceil((loop.time() + delay - self._next_at) / self.tick) + 1)
+        timer = Timer(self, (self.cursor + ticks) % len(self.slots), (ticks - 1) // len(self.slots), callback, args)
+        self.slots[timer.slot].add(timer)
+        self.count += 1
+        return timer
+
+    def _remove(self, timer: Timer):
+        slot = self.slots[timer.slot]
+        if timer in slot:
+            slot.remove(timer)
+            self.count -= 1
+
+    def _advance(self):
+        loop = asyncio.get_running_loop()
+        # Catch up on ticks missed while the loop was busy
+        while self._next_at <= loop.time():
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            self._fire(self.slots[self.cursor])
+            self._next_at += self.tick
+        if self.count:
+            self._handle = loop.call_at(self._next_at, self._advance)
+        else:
+            self._handle = None
+
+    def _fire(self, slot: Set[Timer]):
+        due = [timer for timer in slot if timer.rounds == 0]
+        for timer in slot:
+            timer.rounds -= 1
+        for timer in due:
+            slot.remove(timer)
+            self.count -= 1
+            timer.cancelled = True  # spent; cancel() is a no-op from now on
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                log.exception("Timer callback %r failed", timer.callback)
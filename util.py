@@ -1,9 +1,14 @@
+import asyncio
+import functools
+import os
 import socket
 import json
 from typing import Dict
 from typing import Union
 from websockets.legacy.server import WebSocketServerProtocol
 from websockets.typing import Data
+from log import get_logger
+from codec import codec
 
 
 # Number to body attribute mappings
@@ -11,25 +16,79 @@ NOSE = 1
 CHIN = 152
 FOREHEAD = 10
 
+# Seconds a single recipient gets to accept a frame before it counts as stalled
+SEND_TIMEOUT = float(os.environ.get("MAFIA_SEND_TIMEOUT", "2.0"))
+
+# Keeps fire-and-forget tasks alive until they finish
+_background_tasks = set()
+
+log = get_logger("util")
+
 
 async def send_json(ws: WebSocketServerProtocol, playerName: Union[str, int], action: str, target): ## new sendjson
-    data = {
-        "player": playerName,
-        "action": action,
-        "target": target
-    }
-    await ws.send(json.dumps(data))
+    await ws.send(encode_frame(playerName, encode_body(action, target)))
+
+
+def encode_body(action: str, target) -> str:
+    """
+    @param action: message action
+    @param target: message payload
+
+    Encodes the part of a message that is the same for every recipient.
+    Encode it once per broadcast and wrap it per recipient with encode_frame.
+    """
+    if target is None:
+        return cached_body(action)
+    return codec.dumps({"action": action, "target": target})
+
+
+@functools.lru_cache(maxsize=256)
+def cached_body(action: str) -> str:
+    """
+    Pre-encoded body for target-less messages ("heads_down", roles, vote requests)
+    """
+    return codec.dumps({"action": action, "target": None})
+
 
+@functools.lru_cache(maxsize=4096)
+def _player_envelope(playerName: Union[str, int]) -> str:
+    return '{"player":' + codec.dumps(playerName) + ','
 
 
+def encode_frame(playerName: Union[str, int], body: str) -> str:
+    """
+    @param playerName: recipient name or ID, the only per-recipient field
+    @param body: shared body from encode_body
+
+    Produces the same JSON object as encoding {"player", "action", "target"} directly
+    """
+    return _player_envelope(playerName) + body[1:]
+
+
+def spawn(coro) -> asyncio.Task:
+    """
+    Runs a coroutine in the background, keeping a reference until it's done
+    """
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def drop_connection(ws: WebSocketServerProtocol, reason: str = "Client too slow"):
+    """
+    Closes a connection in the background; the handler's cleanup removes the player
+    """
+    spawn(ws.close(1008, reason))
+
 
 def parse_json(message: Data): ## new parse_json
     try:
-        parsed = json.loads(message)
-        print(parsed)
+        parsed = codec.loads(message)
+        log.debug("Parsed %s", parsed)
         return parsed
-    except json.JSONDecodeError:
-        print("Invalid JSON:", message)
+    except codec.errors:
+        log.warning("Invalid JSON: %r", message)
         return None
 
 def client_connect(RECEIVER_IP, PORT):
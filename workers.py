@@ -0,0 +1,138 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+import zlib
+from typing import Dict
+
+import websockets
+
+from log import get_logger
+from metrics import REGISTRY
+
+# Worker processes sharing the public port ("auto" = one per core); 1 runs a single plain server
+_workers = os.environ.get("MAFIA_WORKERS", "1")
+WORKERS = (os.cpu_count() or 1) if _workers == "auto" else max(1, int(_workers))
+# Set by the supervisor for each worker it starts; -1 means this process is not a worker
+WORKER_INDEX = int(os.environ.get("MAFIA_WORKER_INDEX", "-1"))
+# Worker i also listens on 127.0.0.1:<base + i> for connections routed from the other workers
+WORKER_BASE_PORT = int(os.environ.get("MAFIA_WORKER_BASE_PORT", "5100"))
+# Seconds the supervisor waits before restarting a worker that exited
+RESTART_DELAY = 1.0
+
+ROUTED = REGISTRY.counter("mafia_routed_connections_total", "Connections handed to the worker owning their room", ("worker",))
+
+log = get_logger("workers")
+
+
+def is_worker() -> bool:
+    return WORKER_INDEX >= 0
+
+
+def owner(room_id: str, workers: int = WORKERS) -> int:
+    """The worker a room lives on; crc32 so every process agrees, unlike the salted hash()"""
+    return zlib.crc32(room_id.encode()) % workers
+
+
+def owns(room_id: str) -> bool:
+    return not is_worker() or owner(room_id) == WORKER_INDEX
+
+
+def worker_port(index: int) -> int:
+    return WORKER_BASE_PORT + index
+
+
+async def route(ws, setup_frame, index: int):
+    """
+    @param ws: client connection that landed on the wrong worker
+    @param setup_frame: the setup message it already sent, forwarded first
+    @param index: worker owning the room
+
+    The kernel spreads connections over the workers before anyone knows the
+    room, so a connection for a room owned elsewhere is relayed to the owner
+    over loopback, frame for frame, until either side hangs up.
+    """
+    ROUTED.inc(str(index))
+    try:
+        upstream = await websockets.connect(f"ws://127.0.0.1:{worker_port(index)}", ping_interval=None, max_size=None)
+    except OSError:
+        log.warning("Worker %d is not reachable", index)
+        await ws.close(1013, "Try again later")
+        return
+
+    async def pump(source, sink):
+        try:
+            async for frame in source:
+                await sink.send(frame)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async with upstream:
+        await upstream.send(setup_frame)
+        pumps = [asyncio.create_task(pump(ws, upstream)), asyncio.create_task(pump(upstream, ws))]
+        await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+        for task in pumps:
+            task.cancel()
+    # Pass on why the owner hung up ("Game is full", ...)
+    await ws.close(upstream.close_code or 1000, upstream.close_reason or "")
+
+
+def _start(index: int, count: int) -> subprocess.Popen:
+    env = dict(os.environ, MAFIA_WORKERS=str(count), MAFIA_WORKER_INDEX=str(index))
+    process = subprocess.Popen([sys.executable, *sys.argv], env=env)
+    log.info("Started worker %d (pid %d)", index, process.pid)
+    return process
+
+
+def supervise(count: int = WORKERS):
+    """
+    @param count: worker processes to run
+
+    Starts the workers (each a full server on the shared port, with SO_REUSEPORT)
+    and restarts any that die. Rooms are pinned to workers by owner(), so a
+    restarted worker gets its own rooms back from its journal. SIGHUP (reload
+    the game logic) and SIGUSR1 (drain) are passed on to every worker; once
+    draining, workers are not restarted and the supervisor exits after the last.
+    """
+    workers: Dict[int, subprocess.Popen] = {index: _start(index, count) for index in range(count)}
+    stopping = False
+    draining = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    def forward(signum, frame):
+        nonlocal draining
+        draining = draining or signum == signal.SIGUSR1
+        for process in workers.values():
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, forward)
+    signal.signal(signal.SIGUSR1, forward)
+    try:
+        while not stopping:
+            time.sleep(0.5)
+            if draining and all(process.poll() is not None for process in workers.values()):
+                log.info("All workers drained")
+                break
+            for index, process in workers.items():
+                if process.poll() is not None and not stopping and not draining:
+                    log.warning("Worker %d exited with %s, restarting", index, process.returncode)
+                    time.sleep(RESTART_DELAY)
+                    workers[index] = _start(index, count)
+    finally:
+        for process in workers.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in workers.values():
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        log.info("All workers stopped")